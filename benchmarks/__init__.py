@@ -0,0 +1 @@
+"""synthetic workloads measuring the recorder and the runtime, run with `python -m benchmarks`"""
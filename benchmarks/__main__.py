@@ -0,0 +1,243 @@
+"""
+Benchmarks of pytest_cleanup itself on synthetic workloads.
+`python -m benchmarks [results.json]` runs them and saves the results as json (or prints them),
+`python -m benchmarks compare before.json after.json` compares the results of two runs, e.g of two commits.
+"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+work_directory = tempfile.mkdtemp(prefix='pytest-cleanup-benchmarks-')
+# pytest_cleanup reads its configuration when it's imported
+os.environ['PYTESTCLEANUP_TEST_DIRECTORY'] = work_directory
+os.environ.setdefault('PYTESTCLEANUP_EXCLUDE_MODULES', 'benchmarks.synthetic')
+
+from loguru import logger  # noqa: E402
+
+logger.remove()
+logger.add(sys.stderr, level=os.environ.get('BENCHMARK_LOG_LEVEL', 'WARNING'))
+
+from pytest_cleanup import __version__, constants, Recorder  # noqa: E402
+from pytest_cleanup.recorder import invocation_limit_per_signature  # noqa: E402
+from .synthetic import create_modules, unload_modules  # noqa: E402
+
+repeat_count = int(os.environ.get('BENCHMARK_REPEAT', '5'))
+regression_threshold = float(os.environ.get('BENCHMARK_THRESHOLD', '1.5'))
+call_count = 10000
+module_counts = [10, 100, 500]
+case_counts = [10, 100, 1000]
+payload_sizes = [100, 10000]
+data_file_counts = [10, 100, 500]
+
+
+def best_time(fn):
+    timings = []
+    for _ in range(repeat_count):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def report(results, name, **values):
+    results[name] = values
+    print(f'{name}: {values["seconds"]:.3e}s', file=sys.stderr)
+
+
+def call_many(fn, *args):
+    def run():
+        for _ in range(call_count):
+            fn(*args)
+
+    return run
+
+
+def await_many(loop, fn, *args):
+    async def calls():
+        for _ in range(call_count):
+            await fn(*args)
+
+    return lambda: loop.run_until_complete(calls())
+
+
+def get_workload_calls(loop):
+    """The functions are looked up again after entering the recorder, to get its wrappers"""
+    from benchmarks import workloads
+
+    shape = workloads.Shape(3)
+    return {
+        'sync': call_many(workloads.add, 1, 2),
+        'async': await_many(loop, workloads.add_async, 1, 2),
+        'method': call_many(shape.area),
+        'classmethod': call_many(workloads.Shape.scale_class, 3),
+        'staticmethod': call_many(workloads.Shape.scale_static, 3),
+    }
+
+
+def benchmark_wrapper_overhead(recorder, results):
+    import asyncio
+
+    loop = asyncio.new_event_loop()
+    try:
+        baseline = {name: best_time(run) / call_count for name, run in get_workload_calls(loop).items()}
+        recorder.enter()
+        wrapped = {name: best_time(run) / call_count for name, run in get_workload_calls(loop).items()}
+    finally:
+        loop.close()
+    recorder.invocations = []
+    for name in baseline:
+        report(
+            results,
+            f'wrapper_overhead.{name}',
+            seconds=wrapped[name] - baseline[name],
+            baseline_seconds=baseline[name],
+            wrapped_seconds=wrapped[name],
+        )
+
+
+def benchmark_enter(recorder, results):
+    for module_count in module_counts:
+        timings = []
+        for repetition in range(repeat_count):
+            modules = create_modules(work_directory, f'enter_{module_count}_{repetition}', module_count)
+            loaded_module_count = len(sys.modules)
+            start = time.perf_counter()
+            recorder.enter()
+            timings.append(time.perf_counter() - start)
+            unload_modules(modules)
+        report(results, f'enter.modules_{module_count}', seconds=min(timings), loaded_modules=loaded_module_count)
+
+
+def use_new_test_data_directory(recorder):
+    constants.test_data_directory = tempfile.mkdtemp(dir=work_directory)
+    recorder.retained = {}
+    recorder.invocations = []
+
+
+def get_directory_size(directory):
+    return sum(os.path.getsize(os.path.join(path, x)) for path, _, filenames in os.walk(directory) for x in filenames)
+
+
+def benchmark_exit(recorder, functions, results):
+    for case_count in case_counts:
+        for payload_size in payload_sizes:
+            timings = []
+            for _ in range(repeat_count):
+                use_new_test_data_directory(recorder)
+                for i in range(case_count):
+                    # distinct arguments, so that no case is dropped as a duplicate or over the per-signature limit
+                    fn = functions[i // invocation_limit_per_signature]
+                    recorder.add_invocation(i, fn, ('x' * payload_size, i), {})
+                start = time.perf_counter()
+                recorder.exit()
+                timings.append(time.perf_counter() - start)
+            seconds = min(timings)
+            written = get_directory_size(constants.test_data_directory)
+            report(
+                results,
+                f'exit.cases_{case_count}.payload_{payload_size}',
+                seconds=seconds,
+                cases_per_second=case_count / seconds,
+                bytes_per_second=written / seconds,
+                bytes_written=written,
+            )
+
+
+def benchmark_collection(recorder, functions, results):
+    from pytest_cleanup.runtime import get_data_file_paths, load_data_files
+
+    for file_count in data_file_counts:
+        use_new_test_data_directory(recorder)
+        for i in range(file_count):
+            recorder.add_invocation(i, functions[i], (i,), {})
+        recorder.exit()
+        path_list = get_data_file_paths()
+        loaded = load_data_files(path_list, None)
+        seconds = best_time(lambda: load_data_files(path_list, None))
+        report(
+            results,
+            f'collection.files_{file_count}',
+            seconds=seconds,
+            data_files=len(path_list),
+            loaded_data_files=len([x for x in loaded if x and not isinstance(x, Exception)]),
+        )
+
+
+def make_callback(settings):
+    def callback(value):
+        return value * settings['factor']
+
+    return callback
+
+
+def benchmark_callbacks(recorder, functions, results):
+    """Cases that are passed a local function, created anew for each call as callbacks often are"""
+    from pytest_cleanup.runtime import get_data_file_paths, load_data_files
+
+    case_count = max(case_counts)
+    settings = {'factor': 2}
+    timings = []
+    for _ in range(repeat_count):
+        use_new_test_data_directory(recorder)
+        for i in range(case_count):
+            fn = functions[i // invocation_limit_per_signature]
+            recorder.add_invocation(i, fn, (make_callback(settings), i), {})
+        start = time.perf_counter()
+        recorder.exit()
+        timings.append(time.perf_counter() - start)
+    report(results, f'exit.callbacks.cases_{case_count}', seconds=min(timings))
+    path_list = get_data_file_paths()
+    seconds = best_time(lambda: load_data_files(path_list, None))
+    report(results, f'collection.callbacks.cases_{case_count}', seconds=seconds)
+
+
+def run():
+    recorder = Recorder()
+    results = {}
+    benchmark_wrapper_overhead(recorder, results)
+    benchmark_enter(recorder, results)
+    function_count = max(max(case_counts) // invocation_limit_per_signature + 1, max(data_file_counts))
+    (module,) = create_modules(work_directory, 'exit', 1, function_count)
+    functions = [getattr(module, f'function_{i}') for i in range(function_count)]
+    benchmark_exit(recorder, functions, results)
+    benchmark_collection(recorder, functions, results)
+    benchmark_callbacks(recorder, functions, results)
+    return {'python': sys.version.split()[0], 'pytest_cleanup': __version__, 'results': results}
+
+
+def compare(before_filename, after_filename):
+    """Returns an exit code, non-zero if a benchmark got slower by more than the threshold"""
+    with open(before_filename) as f:
+        before = json.load(f)['results']
+    with open(after_filename) as f:
+        after = json.load(f)['results']
+    regressions = 0
+    for name in sorted(set(before) & set(after)):
+        previous, current = before[name]['seconds'], after[name]['seconds']
+        ratio = current / previous if previous > 0 else 0
+        regressed = ratio > regression_threshold
+        regressions += regressed
+        print(f'{name}: {previous:.3e}s -> {current:.3e}s ({ratio:.2f}x){" REGRESSION" if regressed else ""}')
+    print(f'{regressions} regressions out of {len(set(before) & set(after))} benchmarks')
+    return 1 if regressions else 0
+
+
+def main():
+    try:
+        if sys.argv[1:2] == ['compare']:
+            sys.exit(compare(*sys.argv[2:4]))
+        output = json.dumps(run(), indent=2, sort_keys=True)
+        if len(sys.argv) > 1:
+            with open(sys.argv[1], 'w') as f:
+                f.write(output)
+        else:
+            print(output)
+    finally:
+        shutil.rmtree(work_directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
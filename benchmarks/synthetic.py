@@ -0,0 +1,30 @@
+"""modules generated on the fly, so that workloads can be scaled to any number of modules and functions"""
+import importlib
+import os
+import sys
+
+module_prefix = 'benchmark_module_'
+
+
+def get_module_source(function_count):
+    functions = [f'def function_{i}(value):\n    return value\n' for i in range(function_count)]
+    methods = [f'    def method_{i}(self, value):\n        return value\n' for i in range(function_count)]
+    return '\n\n'.join(functions) + '\n\nclass Synthetic:\n' + '\n'.join(methods)
+
+
+def create_modules(directory, name, count, function_count=5):
+    """Writes and imports `count` modules with `function_count` functions and methods each"""
+    if directory not in sys.path:
+        sys.path.insert(0, directory)
+    source = get_module_source(function_count)
+    module_names = [f'{module_prefix}{name}_{i}' for i in range(count)]
+    for module_name in module_names:
+        with open(os.path.join(directory, f'{module_name}.py'), 'w') as f:
+            f.write(source)
+    importlib.invalidate_caches()
+    return [importlib.import_module(x) for x in module_names]
+
+
+def unload_modules(modules):
+    for module in modules:
+        sys.modules.pop(module.__name__, None)
@@ -0,0 +1,27 @@
+"""functions whose calls are timed with and without the recorder's wrappers"""
+
+
+def add(a, b):
+    return a + b
+
+
+async def add_async(a, b):
+    return a + b
+
+
+class Shape:
+    factor = 2
+
+    def __init__(self, size):
+        self.size = size
+
+    def area(self):
+        return self.size * self.size
+
+    @classmethod
+    def scale_class(cls, size):
+        return size * cls.factor
+
+    @staticmethod
+    def scale_static(size):
+        return size * 2
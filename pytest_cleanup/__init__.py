@@ -2,9 +2,24 @@
 
 import os
 
-from .recorder import Recorder, get_test_data_filename, user_function
-from .runtime import parametrize_stg_tests
-
 __version__ = os.environ.get('VERSION', '0')
 
-__all__ = ['parametrize_stg_tests', 'Recorder', 'get_test_data_filename', 'user_function']
+__all__ = ['parametrize_stg_tests', 'add_pytest_options', 'Recorder', 'get_test_data_filename', 'user_function']
+
+# submodules are imported on first use so that e.g recording doesn't pay for importing pytest
+_lazy_attributes = {
+    'Recorder': 'recorder',
+    'get_test_data_filename': 'recorder',
+    'user_function': 'recorder',
+    'parametrize_stg_tests': 'runtime',
+    'add_pytest_options': 'runtime',
+}
+
+
+def __getattr__(name):
+    if name not in _lazy_attributes:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    import importlib
+
+    module = importlib.import_module(f'.{_lazy_attributes[name]}', __name__)
+    return getattr(module, name)
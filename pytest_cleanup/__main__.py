@@ -44,6 +44,32 @@ def main():
     if len(sys.argv) < 2:
         save_example_scripts()
         return
+    if sys.argv[1] == 'minimise':
+        from pytest_cleanup.minimise import minimise
+
+        minimise(dry_run='--dry-run' in sys.argv[2:])
+        return
+    if sys.argv[1] == 'batch':
+        from pytest_cleanup.batch import batch, read_manifest
+
+        arguments = sys.argv[2:]
+        targets = []
+        while arguments:
+            argument = arguments.pop(0)
+            if argument == '--manifest':
+                targets.extend(read_manifest(arguments.pop(0)))
+            else:
+                targets.append(argument)
+        sys.exit(batch(targets))
+    if sys.argv[1] == 'merge':
+        from pytest_cleanup.merge import merge
+
+        merge(sys.argv[2:])
+        return
+    if sys.argv[1] == 'benchmark':
+        from pytest_cleanup.benchmark import benchmark
+
+        sys.exit(benchmark(save='--save' in sys.argv[2:]))
     module_path = get_module_path(sys.argv[-1])
     module = load_user_function(module_path)
 
@@ -0,0 +1,86 @@
+"""Records many entry points in parallel, i.e `python -m pytest_cleanup batch <module:function...>`."""
+import os
+import shutil
+import tempfile
+from itertools import repeat
+
+from loguru import logger
+
+from pytest_cleanup import constants
+
+batch_workers = int(os.environ.get('PYTESTCLEANUP_BATCH_WORKERS', '0')) or os.cpu_count() or 1
+
+
+def read_manifest(filename):
+    """One `module:function` target per line, blank lines and lines starting with # are ignored"""
+    with open(filename) as f:
+        lines = [line.strip() for line in f]
+    return [line for line in lines if line and not line.startswith('#')]
+
+
+def record_target(target, test_data_directory, saturated_functions):
+    """
+    Runs in a worker process of its own, so that each target is recorded in isolation.
+    `saturated_functions` are looked up in the actual test data directory, `test_data_directory` only gets the new data.
+    Returns an error message if the target could not be run.
+    """
+    import importlib
+
+    from pytest_cleanup import Recorder, user_function
+    from pytest_cleanup.__main__ import get_module_path
+
+    constants.test_data_directory = test_data_directory
+    module_path, _, function_name = target.partition(':')
+    function_name = function_name or user_function
+    try:
+        # must load module early so that Recorder can find it and patch it
+        module = importlib.import_module(get_module_path(module_path))
+    except Exception as e:
+        return f'Could not import {target}: {e}'
+    if not callable(getattr(module, function_name, None)):
+        return f'{target}: {module.__name__} has no function {function_name}'
+    recorder = Recorder()
+    recorder.enter(saturated_functions)
+    try:
+        # looked up once patched, so that the entry point itself is recorded too
+        getattr(module, function_name)()
+    except Exception as e:
+        # what was recorded until then is still kept
+        return f'{target} failed: {e}'
+    finally:
+        recorder.exit(save_scripts=False)
+
+
+def batch(targets):
+    """
+    Records each target on a pool of `batch_workers` processes, each in its own test data directory,
+    then merges them into the test data directory. Returns an exit code, non-zero if a target failed.
+    """
+    import multiprocessing
+
+    from pytest_cleanup.merge import merge
+    from pytest_cleanup.recorder import get_saturated_functions, record_saturated_functions, save_example_scripts
+
+    if not targets:
+        logger.error('No targets to record, pass module:function targets or --manifest with a file listing them')
+        return 1
+    # the workers record into directories of their own, that don't have the data already recorded
+    saturated_functions = {} if record_saturated_functions else get_saturated_functions()
+    directories = [tempfile.mkdtemp(prefix='pytest-cleanup-batch-') for _ in targets]
+    try:
+        # spawned, and not reused, so that no worker inherits modules patched by another recording
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(min(batch_workers, len(targets)) or 1, maxtasksperchild=1) as pool:
+            arguments = zip(targets, directories, repeat(saturated_functions))
+            errors = pool.starmap(record_target, arguments, chunksize=1)
+        for error in errors:
+            if error:
+                logger.error(error)
+        merge(directories)
+    finally:
+        for directory in directories:
+            shutil.rmtree(directory, ignore_errors=True)
+    save_example_scripts()
+    failures = len([x for x in errors if x])
+    logger.info(f'Recorded {len(targets) - failures} of {len(targets)} targets')
+    return 1 if failures else 0
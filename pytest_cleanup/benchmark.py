@@ -0,0 +1,104 @@
+"""Replays the recorded test cases as micro-benchmarks, i.e `python -m pytest_cleanup benchmark`."""
+import json
+import os
+import statistics
+import time
+
+from loguru import logger
+
+from pytest_cleanup import constants
+from pytest_cleanup.runtime import get_data_file_paths, load_data_file, run_test_case
+
+warmup_count = int(os.environ.get('PYTESTCLEANUP_BENCHMARK_WARMUP', '3'))
+repeat_count = int(os.environ.get('PYTESTCLEANUP_BENCHMARK_REPEAT', '20'))
+regression_threshold = float(os.environ.get('PYTESTCLEANUP_BENCHMARK_THRESHOLD', '1.5'))
+baseline_filename = os.environ.get(
+    'PYTESTCLEANUP_BENCHMARK_BASELINE', os.path.join(constants.test_directory, 'pytest-cleanup-benchmark.json')
+)
+min_repetition_seconds = 0.001
+
+
+def time_calls(fn, args, kwargs, loop, number):
+    start = time.perf_counter()
+    for _ in range(number):
+        run_test_case(fn, args, kwargs, loop)
+    return time.perf_counter() - start
+
+
+def get_call_count(fn, args, kwargs, loop):
+    """Like timeit's autorange: how many calls are needed for a repetition to be long enough to be timed reliably"""
+    number = 1
+    while number < 1000000:
+        if time_calls(fn, args, kwargs, loop, number) >= min_repetition_seconds:
+            break
+        number *= 10
+    return number
+
+
+def time_test_case(fn, args, kwargs, loop):
+    number = get_call_count(fn, args, kwargs, loop)
+    for _ in range(warmup_count):
+        time_calls(fn, args, kwargs, loop, number)
+    timings = [time_calls(fn, args, kwargs, loop, number) / number for _ in range(repeat_count)]
+    return {
+        'min': min(timings),
+        'median': statistics.median(timings),
+        'mean': statistics.mean(timings),
+        'stdev': statistics.stdev(timings) if len(timings) > 1 else 0.0,
+        'calls_per_repetition': number,
+        'repetitions': repeat_count,
+    }
+
+
+def run_benchmarks():
+    import asyncio
+
+    results = {}
+    loop = asyncio.new_event_loop()
+    try:
+        for data_file_path in get_data_file_paths():
+            tuple_result = load_data_file(data_file_path)
+            if not tuple_result:
+                continue
+            name = os.path.relpath(data_file_path, constants.test_data_directory).replace(os.sep, '/')
+            for index, (fn, args, kwargs, *_) in enumerate(tuple_result[2]):
+                case_name = f'{name}::{index}'
+                try:
+                    results[case_name] = time_test_case(fn, args, kwargs, loop)
+                except Exception as e:
+                    logger.warning(f'Could not benchmark {case_name}: {e}')
+                    continue
+                logger.debug(f'{case_name}: median {results[case_name]["median"]:.3e}s')
+    finally:
+        loop.close()
+    return results
+
+
+def find_regressions(results, baseline):
+    regressions = []
+    for case_name, stats in results.items():
+        if case_name not in baseline:
+            continue
+        previous = baseline[case_name]['median']
+        ratio = stats['median'] / previous if previous else 0
+        if ratio > regression_threshold:
+            regressions.append((case_name, previous, stats['median'], ratio))
+    return regressions
+
+
+def benchmark(save=False):
+    """Returns an exit code, non-zero if a test case got slower than the baseline by more than the threshold"""
+    results = run_benchmarks()
+    if save or not os.path.exists(baseline_filename):
+        logger.info(f'Saving benchmark baseline of {len(results)} test cases at {baseline_filename}')
+        with open(baseline_filename, 'w') as f:
+            f.write(json.dumps(results, indent=2, sort_keys=True))
+        return 0
+
+    with open(baseline_filename) as f:
+        baseline = json.load(f)
+    regressions = find_regressions(results, baseline)
+    for case_name, previous, current, ratio in regressions:
+        logger.error(f'{case_name} is {ratio:.2f}x slower than the baseline ({previous:.3e}s -> {current:.3e}s)')
+    logger.info(f'Compared {len(results)} test cases against {baseline_filename}, {len(regressions)} regressions')
+    return 1 if regressions else 0
@@ -1,17 +1,37 @@
+import contextlib
+import functools
 import inspect
+import itertools
 import os
+import sys
+import time
+from collections.abc import Iterator
+from types import GeneratorType
 
-import dill
 from loguru import logger
 
-from pytest_cleanup.constants import test_data_directory
+from pytest_cleanup import constants
+from pytest_cleanup.sidecar import SidecarBuffer
 
 log_level = os.environ.get('PYTESTCLEANUP_LOG_LEVEL', 'TRACE')
 pytestcleanup_decorated_with_record_test_data = 'pytestcleanup_decorated_with_record_test_data'
+generator_item_limit = int(os.environ.get('PYTESTCLEANUP_GENERATOR_ITEM_LIMIT', '100'))
+latency_budget_multiple = float(os.environ.get('PYTESTCLEANUP_LATENCY_BUDGET', '0'))
+latency_budget_floor = float(os.environ.get('PYTESTCLEANUP_LATENCY_BUDGET_FLOOR_MS', '1')) / 1000
+# pickled local functions by memo key, only while in memoised_dill_dumps
+_dumps_memo = None
+# pickled stateless function -> function, see load_dill_memoised
+_loads_memo = {}
+loads_memo_size = 1024
 
 
 def get_test_data_filename(subdir, filename):
-    return f'{test_data_directory}/{subdir}/{filename}.json'
+    return f'{constants.test_data_directory}/{subdir}/{filename}.json'
+
+
+def get_test_data_subdir(module_name, clazz, function_name):
+    class_or_module_name = get_name(clazz) or module_name
+    return f'{module_name}/{class_or_module_name}/{function_name}'
 
 
 def is_async_fn(param):
@@ -94,10 +114,14 @@ def is_local_function(param):
 
 
 def try_load_dill(param):
+    import dill
+
     return _try_dill(dill.loads, param)
 
 
 def try_dump_dill(param):
+    import dill
+
     return _try_dill(dill.dumps, param)
 
 
@@ -107,6 +131,160 @@ def unwrap_function(fn):
     return fn
 
 
+def get_source_hash(fn):
+    """Hash of the function's source code, falling back to its bytecode when the source isn't available."""
+    import hashlib
+
+    fn = unwrap_function(fn)
+    try:
+        contents = inspect.getsource(fn).encode()
+    except (OSError, TypeError):
+        code = getattr(fn, '__code__', None)
+        if code is None:
+            return None
+        import marshal
+
+        contents = marshal.dumps(code)
+    return hashlib.sha1(contents).hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def get_file_hash(filename):
+    import hashlib
+
+    try:
+        with open(filename, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except OSError:
+        return None
+
+
+def get_module_source_hash(module):
+    filename = getattr(module, '__file__', None)
+    return get_file_hash(filename) if filename else None
+
+
+def get_referenced_names(code):
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            names.update(get_referenced_names(const))
+    return names
+
+
+def get_dependency_hashes(fn, is_module_allowed):
+    """
+    Source hashes of the globals in allowed modules that the function refers to: functions and classes by their own
+    source, keyed `module:qualname`, anything else by the source of its whole module, keyed by the module name.
+    The function's own module isn't hashed as a whole, or any edit to it would count as a change of the function.
+    """
+    import types
+
+    fn = unwrap_function(fn)
+    code = getattr(fn, '__code__', None)
+    fn_globals = getattr(fn, '__globals__', {})
+    own_module = sys.modules.get(getattr(fn, '__module__', None))
+    modules = set()
+    result = {}
+    for name in get_referenced_names(code) if code else ():
+        value = unwrap_function(fn_globals.get(name))
+        if value is None:
+            continue
+        if isinstance(value, types.ModuleType):
+            modules.add(value)
+            continue
+        module = sys.modules.get(getattr(value, '__module__', None))
+        if module is None or not is_module_allowed(module):
+            continue
+        if inspect.isfunction(value) or inspect.isclass(value):
+            source_hash = get_source_hash(value)
+            if source_hash:
+                result[f'{module.__name__}:{value.__qualname__}'] = source_hash
+        elif module is not own_module:
+            modules.add(module)
+    for module in modules:
+        if module is None or not is_module_allowed(module):
+            continue
+        source_hash = get_module_source_hash(module)
+        if source_hash:
+            result[module.__name__] = source_hash
+    return result
+
+
+@contextlib.contextmanager
+def memoised_dill_dumps():
+    """Within this context, a local function passed or returned in many cases is only pickled once"""
+    global _dumps_memo
+    previous, _dumps_memo = _dumps_memo, {}
+    try:
+        yield
+    finally:
+        _dumps_memo = previous
+
+
+def get_dumps_memo_keys(fn):
+    """
+    The function's identity, and for plain functions its code, globals, closure contents and defaults.
+    The latter matches the closures that are created anew for each call, e.g callbacks defined in a loop.
+    """
+    import types
+
+    keys = [('id', id(fn))]
+    if isinstance(fn, types.FunctionType) and not fn.__dict__:
+        try:
+            closure = tuple(id(cell.cell_contents) for cell in fn.__closure__ or ())
+        except ValueError:
+            # empty cell
+            return keys
+        keys.append(('code', id(fn.__code__), id(fn.__globals__), closure, id(fn.__defaults__), id(fn.__kwdefaults__)))
+    return keys
+
+
+def dump_dill_memoised(param):
+    import dill
+
+    if _dumps_memo is None:
+        return dill.dumps(param)
+    keys = get_dumps_memo_keys(param)
+    for key in keys:
+        if key in _dumps_memo:
+            return _dumps_memo[key][1]
+    result = dill.dumps(param)
+    for key in keys:
+        # keeps a reference to the function, so that the ids in its keys aren't reused
+        _dumps_memo[key] = (param, result)
+    return result
+
+
+def is_stateless_function(value):
+    """Whether calls can't change the function: no closure, defaults or attributes, and the globals of its module"""
+    if not inspect.isfunction(value) or value.__closure__ or value.__defaults__ or value.__kwdefaults__:
+        return False
+    if value.__dict__:
+        return False
+    module = sys.modules.get(value.__module__)
+    return module is not None and value.__globals__ is module.__dict__
+
+
+def load_dill_memoised(contents: bytes):
+    """
+    Returns whether `contents` could be unpickled, and the result.
+    Stateless functions are loaded once and shared by test cases, everything else is loaded anew for each case,
+    so that a case can't see the state that another one left, e.g in a closure.
+    """
+    if contents in _loads_memo:
+        return True, _loads_memo[contents]
+    import dill
+
+    try:
+        value = dill.loads(contents)
+    except Exception:
+        return False, None
+    if len(_loads_memo) < loads_memo_size and is_stateless_function(value):
+        _loads_memo[contents] = value
+    return True, value
+
+
 def _try_dill(dill_fn, param):
     if isinstance(param, tuple):  # is args
         result = []
@@ -118,17 +296,199 @@ def _try_dill(dill_fn, param):
         for k, v in param.items():
             result[k] = _try_dill(dill_fn, v)
         return result
+    if isinstance(param, SidecarBuffer):
+        # buffers are externalised before pickling, their contents are never a dill payload
+        return param
+    import dill
+
     result = unwrap_function(param)
+    if dill_fn == dill.loads and isinstance(param, bytes):
+        loaded, value = load_dill_memoised(param)
+        return value if loaded else result
     if dill_fn == dill.loads or (dill_fn == dill.dumps and is_local_function(param)):
         try:
-            result = dill_fn(param)
+            result = dump_dill_memoised(param) if dill_fn == dill.dumps else dill_fn(param)
         except:
             pass
     return result
 
 
+def sort_set_items(encoded):
+    """Sorts the items of the sets and frozensets of a decoded jsonpickle document, which are in hash order"""
+    import json
+
+    if isinstance(encoded, list):
+        return [sort_set_items(x) for x in encoded]
+    if not isinstance(encoded, dict):
+        return encoded
+    result = {k: sort_set_items(v) for k, v in encoded.items()}
+    if 'py/set' in result:
+        result['py/set'] = sorted(result['py/set'], key=lambda x: json.dumps(x, sort_keys=True))
+    reduce_args = result.get('py/reduce')
+    if reduce_args and reduce_args[0] == {'py/type': 'builtins.frozenset'}:
+        (items,) = reduce_args[1]['py/tuple']
+        reduce_args[1] = {'py/tuple': [sorted(items, key=lambda x: json.dumps(x, sort_keys=True))]}
+    return result
+
+
+def encode_canonical(value):
+    """
+    Json of `value` that is the same for equal values across runs, or None if there's no such json:
+    references (py/id) are numbered in traversal order, which isn't stable when they're in sets.
+    """
+    import json
+    import jsonpickle
+
+    encoded = jsonpickle.encode(value)
+    if 'py/id' in encoded and ('py/set' in encoded or 'builtins.frozenset' in encoded):
+        return None
+    return json.dumps(sort_set_items(json.loads(encoded)), sort_keys=True, separators=(',', ':'))
+
+
+def get_digest(encoded):
+    import hashlib
+
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+
+class ReturnValueDigest:
+    """
+    Stands in for a large return value in data files: only the digest of its canonical json is kept.
+    The full value may be kept in a side file named after the digest, used to show a diff on failure.
+    """
+
+    def __init__(self, digest, encoded=None):
+        self.digest = digest
+        self.encoded = encoded
+        self.directory = None
+
+    def __getstate__(self):
+        return {'digest': self.digest}
+
+    def __setstate__(self, state):
+        self.__init__(state['digest'])
+
+    def __eq__(self, other):
+        return isinstance(other, ReturnValueDigest) and self.digest == other.digest
+
+    def get_side_filename(self, directory):
+        return os.path.join(directory, f'{self.digest}.expected')
+
+    def load_value(self):
+        import jsonpickle
+
+        side_filename = self.get_side_filename(self.directory or '')
+        if not os.path.exists(side_filename):
+            return
+        with open(side_filename) as f:
+            return jsonpickle.decode(f.read())
+
+    def assert_matches(self, actual):
+        encoded = encode_canonical(actual)
+        if encoded is not None and get_digest(encoded) == self.digest:
+            return
+        expected = self.load_value()
+        if expected is not None:
+            assert actual == expected
+            return
+        assert False, f'Return value does not match the recorded digest {self.digest}'
+
+
+class GeneratorPrefix:
+    """The first items yielded by a generator, `exhausted` if the generator ended within them."""
+
+    def __init__(self, items, exhausted):
+        self.items = items
+        self.exhausted = exhausted
+
+    @classmethod
+    def from_iterator(cls, iterator, limit=None):
+        limit = generator_item_limit if limit is None else limit
+        items = list(itertools.islice(iterator, limit + 1))
+        return cls(items[:limit], exhausted=len(items) <= limit)
+
+    def __eq__(self, other):
+        return isinstance(other, GeneratorPrefix) and (self.items, self.exhausted) == (other.items, other.exhausted)
+
+    def __repr__(self):
+        return f'GeneratorPrefix({self.items!r}{"" if self.exhausted else ", ..."})'
+
+    def is_unobserved(self):
+        """Nothing was taken from the generator, any generator would match"""
+        return not self.items and not self.exhausted
+
+    def assert_matches(self, actual):
+        """Consumes `actual` one item at a time, stopping at the first mismatch"""
+        assert isinstance(actual, (Iterator, list)), f'Expected a generator, got {actual!r}'
+        actual = iter(actual)
+        end = object()
+        for index, expected_item in enumerate(self.items):
+            actual_item = next(actual, end)
+            assert actual_item is not end, f'Generator stopped after {index} items, expected {self.items!r}'
+            assert_return_values(actual_item, expected_item)
+        if self.exhausted:
+            assert next(actual, end) is end, f'Generator yielded more than the expected {self.items!r}'
+
+
+def record_generator(generator):
+    """
+    Returns a GeneratorPrefix along with a generator that yields, receives and raises whatever `generator` does.
+    Nothing is taken from `generator` ahead of the caller: the prefix gets its first items as the caller consumes them,
+    and is marked exhausted if the generator ends within them.
+    """
+    prefix = GeneratorPrefix([], exhausted=False)
+
+    def passthrough():
+        step, value = generator.send, None
+        count = 0
+        while True:
+            try:
+                item = step(value)
+            except StopIteration as e:
+                prefix.exhausted = count <= generator_item_limit
+                return e.value
+            count += 1
+            if count <= generator_item_limit:
+                prefix.items.append(item)
+            try:
+                step, value = generator.send, (yield item)
+            except GeneratorExit:
+                generator.close()
+                raise
+            except BaseException as e:
+                step, value = generator.throw, e
+
+    return prefix, passthrough()
+
+
 def assert_return_values(actual, expected):
+    if isinstance(expected, ReturnValueDigest):
+        expected.assert_matches(actual)
+        return
+    if isinstance(actual, GeneratorType) and isinstance(expected, list):
+        expected = GeneratorPrefix(expected, exhausted=True)
+    if isinstance(expected, GeneratorPrefix):
+        expected.assert_matches(actual)
+        return
     if is_function(actual) and is_function(expected):
         assert unwrap_function(actual).__code__ == expected.__code__
         return
     assert actual == expected
+
+
+@contextlib.contextmanager
+def latency_budget(recorded_duration):
+    """
+    Fails if the body takes longer than PYTESTCLEANUP_LATENCY_BUDGET times the duration of the recorded call.
+    Disabled if the budget isn't set or if the data file predates duration recording.
+    """
+    start = time.perf_counter()
+    yield
+    elapsed = time.perf_counter() - start
+    if not latency_budget_multiple or recorded_duration is None:
+        return
+    allowed = max(recorded_duration * latency_budget_multiple, latency_budget_floor)
+    assert elapsed <= allowed, (
+        f'Took {elapsed:.6f}s, over the budget of {allowed:.6f}s '
+        f'({latency_budget_multiple} times the recorded {recorded_duration:.6f}s)'
+    )
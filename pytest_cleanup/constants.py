@@ -19,7 +19,17 @@ def get_test_dir():
     return result
 
 
+def __getattr__(name):
+    # test_directory and test_data_directory probe the filesystem, so they're only looked up on first use
+    if name == 'test_directory':
+        value = get_test_dir()
+    elif name == 'test_data_directory':
+        value = get_test_data_directory(globals().get('test_directory') or __getattr__('test_directory'))
+    else:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    globals()[name] = value
+    return value
+
+
 test_filename = 'test_pytestcleanup_cases.py'
-test_directory = get_test_dir()
-test_data_directory = get_test_data_directory(test_directory)
 filename_count_limit = 10
@@ -0,0 +1,166 @@
+"""Merges test data directories, e.g captured on many hosts, i.e `python -m pytest_cleanup merge <directories...>`."""
+import hashlib
+import json
+import os
+import shutil
+from glob import glob
+from itertools import repeat
+
+from loguru import logger
+
+from pytest_cleanup import constants
+from pytest_cleanup.constants import filename_count_limit
+from pytest_cleanup.recorder import invocation_limit_per_function
+
+merge_workers = int(os.environ.get('PYTESTCLEANUP_MERGE_WORKERS', '0')) or os.cpu_count() or 1
+
+
+def get_function_subdirs(directory):
+    """Paths of the function directories relative to `directory`, i.e module/class_or_module/function"""
+    sep = os.sep
+    return {
+        os.path.relpath(os.path.dirname(x), directory)
+        for x in glob(f'{directory}{sep}*{sep}**{sep}*.json', recursive=True)
+    }
+
+
+def get_content_hash(value):
+    contents = value if isinstance(value, str) else json.dumps(value, sort_keys=True)
+    return hashlib.sha1(contents.encode()).hexdigest()
+
+
+class FunctionMerge:
+    """The data files of one function across all the directories, merged one file at a time"""
+
+    def __init__(self):
+        # header (everything but the test cases) hash -> (header, test cases)
+        self.groups = {}
+        # files that are copied as they are, by content hash
+        self.whole_files = {}
+        self.case_hashes = set()
+        self.case_counts = {}
+        self.side_files = {}
+        self.stats = {'data_files': 0, 'cases': 0, 'duplicates': 0, 'over_limit': 0}
+
+    def add_file(self, path):
+        with open(path) as f:
+            contents = f.read()
+        self.stats['data_files'] += 1
+        try:
+            data = json.loads(contents)
+        except ValueError:
+            logger.warning(f'Could not parse {path}, copying it as is')
+            data = None
+        if not isinstance(data, dict) or not isinstance(data.get('test_cases'), list):
+            self.add_whole_file(contents)
+            return
+        source_hash = data.get('source_hash')
+        if 'py/id' in contents:
+            # jsonpickle references (py/id) are positional, moving cases to another file would break them
+            self.case_counts[source_hash] = self.case_counts.get(source_hash, 0) + len(data['test_cases'])
+            if self.add_whole_file(contents):
+                self.stats['cases'] += len(data['test_cases'])
+            return
+        header = {k: v for k, v in data.items() if k != 'test_cases'}
+        _, cases = self.groups.setdefault(get_content_hash(header), (header, []))
+        for case in data['test_cases']:
+            # durations vary between hosts, they don't make a case different
+            case_hash = get_content_hash([source_hash, {k: v for k, v in case.items() if k != 'duration'}])
+            if case_hash in self.case_hashes:
+                self.stats['duplicates'] += 1
+                continue
+            if self.case_counts.get(source_hash, 0) >= invocation_limit_per_function:
+                self.stats['over_limit'] += 1
+                continue
+            self.case_hashes.add(case_hash)
+            self.case_counts[source_hash] = self.case_counts.get(source_hash, 0) + 1
+            cases.append(case)
+            self.stats['cases'] += 1
+
+    def add_whole_file(self, contents):
+        content_hash = get_content_hash(contents)
+        if content_hash in self.whole_files:
+            self.stats['duplicates'] += 1
+            return False
+        self.whole_files[content_hash] = contents
+        return True
+
+    def add_directory(self, function_directory):
+        if not os.path.isdir(function_directory):
+            return
+        for filename in sorted(os.listdir(function_directory)):
+            path = os.path.join(function_directory, filename)
+            if filename.endswith('.json'):
+                self.add_file(path)
+            elif os.path.isfile(path):
+                # digests and sidecar buffers are named after their contents
+                self.side_files.setdefault(filename, path)
+
+    def get_contents(self):
+        result = [
+            json.dumps({**header, 'test_cases': cases}, indent=2, sort_keys=True)
+            for header, cases in self.groups.values()
+            if cases
+        ]
+        return result + list(self.whole_files.values())
+
+    def write(self, output_function_directory):
+        contents_list = self.get_contents()
+        if len(contents_list) > filename_count_limit:
+            logger.warning(
+                f'{output_function_directory} would need {len(contents_list)} data files, only keeping the first '
+                f'{filename_count_limit}'
+            )
+            contents_list = contents_list[:filename_count_limit]
+        os.makedirs(output_function_directory, exist_ok=True)
+        for filename, path in self.side_files.items():
+            destination = os.path.join(output_function_directory, filename)
+            if not os.path.exists(destination):
+                shutil.copyfile(path, destination)
+        # the new files are complete before any of the previous ones is removed
+        for index, contents in enumerate(contents_list):
+            with open(os.path.join(output_function_directory, f'{index + 1:02}.json.merging'), 'w') as f:
+                f.write(contents)
+        for filename in os.listdir(output_function_directory):
+            if filename.endswith('.json'):
+                os.remove(os.path.join(output_function_directory, filename))
+        for index in range(len(contents_list)):
+            path = os.path.join(output_function_directory, f'{index + 1:02}.json')
+            os.replace(f'{path}.merging', path)
+
+
+def merge_function(subdir, directories, output_directory):
+    function_merge = FunctionMerge()
+    for directory in directories:
+        function_merge.add_directory(os.path.join(directory, subdir))
+    function_merge.write(os.path.join(output_directory, subdir))
+    return function_merge.stats
+
+
+def merge(input_directories, output_directory=None):
+    """
+    Merges the data files of `input_directories` into `output_directory` (the test data directory by default),
+    whose own data files are merged too. Cases are deduplicated by their contents, and capped per function version.
+    Each function is merged on its own, on a pool of `merge_workers` processes.
+    """
+    output_directory = output_directory or constants.test_data_directory
+    directories = [output_directory] + [
+        x for x in input_directories if os.path.abspath(x) != os.path.abspath(output_directory)
+    ]
+    subdirs = sorted(set().union(*[get_function_subdirs(x) for x in directories]))
+    if merge_workers <= 1 or len(subdirs) <= 1:
+        results = [merge_function(x, directories, output_directory) for x in subdirs]
+    else:
+        from concurrent import futures
+
+        with futures.ProcessPoolExecutor(merge_workers) as executor:
+            chunksize = max(1, len(subdirs) // (merge_workers * 4))
+            arguments = subdirs, repeat(directories), repeat(output_directory)
+            results = list(executor.map(merge_function, *arguments, chunksize=chunksize))
+    totals = {key: sum(x[key] for x in results) for key in ['data_files', 'cases', 'duplicates', 'over_limit']}
+    logger.info(
+        f'Merged {totals["data_files"]} data files of {len(subdirs)} functions from {len(directories)} directories '
+        f'into {output_directory}: kept {totals["cases"]} cases, dropped {totals["duplicates"]} duplicates and '
+        f'{totals["over_limit"]} cases over the limit'
+    )
+    return totals
@@ -0,0 +1,186 @@
+"""Offline minimisation of the test data directory, i.e `python -m pytest_cleanup minimise`."""
+import inspect
+import json
+import os
+import time
+from typing import List
+
+from loguru import logger
+
+from pytest_cleanup.common import assert_return_values
+from pytest_cleanup.runtime import get_data_file_paths, load_data_file, run_test_case
+from pytest_cleanup.tracing import LineCoverage
+
+
+class MeasuredCase:
+    def __init__(self, data_file_path, index, subdir):
+        self.data_file_path = data_file_path
+        self.index = index
+        self.subdir = subdir
+        self.lines = None
+        self.duration = None
+        self.required = False
+
+    def cost(self):
+        return max(self.duration or 0, 1e-9)
+
+
+def get_source_filename(fn):
+    code = getattr(getattr(fn, '__wrapped__', fn), '__code__', None)
+    return code.co_filename if code else None
+
+
+def load_test_cases(path_list):
+    result = {}
+    for data_file_path in path_list:
+        try:
+            tuple_result = load_data_file(data_file_path)
+        except Exception as e:
+            logger.error(f'Could not load data file {data_file_path}, keeping it as is')
+            logger.error(e)
+            continue
+        if tuple_result:
+            result[data_file_path] = tuple_result[2]
+    return result
+
+
+def check_test_case(fn, args, kwargs, expected, loop):
+    """Replays a case the way the generated tests do, failing if its result doesn't match the recorded one"""
+    actual = fn(*args, **kwargs)
+    if inspect.iscoroutine(actual):
+        actual = loop.run_until_complete(actual)
+    try:
+        assert_return_values(actual, expected)
+    except AssertionError as e:
+        raise AssertionError(str(e) or f'expected {expected!r}, got {actual!r}') from e
+
+
+def measure_test_cases(data_file_path, test_cases, filenames, loop) -> List[MeasuredCase]:
+    with open(data_file_path) as f:
+        # jsonpickle references (py/id) are positional, removing cases before them would break the file
+        has_references = 'py/id' in f.read()
+    subdir = os.path.dirname(data_file_path)
+    result = []
+    for index, (fn, args, kwargs, expected, *_) in enumerate(test_cases):
+        case = MeasuredCase(data_file_path, index, subdir)
+        result.append(case)
+        try:
+            with LineCoverage(filenames) as coverage:
+                check_test_case(fn, args, kwargs, expected, loop)
+            start = time.perf_counter()
+            run_test_case(fn, args, kwargs, loop)
+            case.duration = time.perf_counter() - start
+        except AssertionError as e:
+            # it would fail as a test too, dropping it would hide that
+            logger.warning(f'Case {index} of {data_file_path} does not match its recorded result ({e}), keeping it')
+            case.required = True
+            continue
+        except Exception as e:
+            logger.warning(f'Case {index} of {data_file_path} failed while replaying ({e}), keeping it')
+            case.required = True
+            continue
+        case.lines = coverage.lines
+        if case.lines is None or has_references:
+            case.required = True
+    return result
+
+
+def select_cases(cases: List[MeasuredCase]):
+    """
+    Greedy weighted set cover: keeps the cases covering the most new lines per second of runtime
+    until all lines covered by the whole suite are covered. Every function keeps at least its cheapest case.
+    """
+    selected = [case for case in cases if case.required]
+    covered = set()
+    for case in selected:
+        covered.update(case.lines or ())
+    total = set(covered)
+    for case in cases:
+        total.update(case.lines or ())
+
+    remaining = [case for case in cases if not case.required]
+    while covered != total:
+        best = max(remaining, key=lambda c: len(c.lines - covered) / c.cost())
+        remaining.remove(best)
+        selected.append(best)
+        covered.update(best.lines)
+
+    subdirs = {case.subdir for case in selected}
+    for case in sorted(remaining, key=MeasuredCase.cost):
+        if case.subdir not in subdirs:
+            subdirs.add(case.subdir)
+            selected.append(case)
+    return selected
+
+
+def rewrite_data_file(data_file_path, indices):
+    with open(data_file_path) as f:
+        data = json.load(f)
+    test_cases = data['test_cases']
+    if len(indices) == len(test_cases):
+        return False
+    if not indices:
+        logger.debug(f'Removing {data_file_path}, all of its cases are redundant')
+        os.remove(data_file_path)
+        return True
+    data['test_cases'] = [case for index, case in enumerate(test_cases) if index in indices]
+    logger.debug(f'Keeping {len(indices)} of {len(test_cases)} cases in {data_file_path}')
+    with open(data_file_path, 'w') as f:
+        f.write(json.dumps(data, indent=2, sort_keys=True))
+    return True
+
+
+def remove_unreferenced_side_files(subdir):
+    """Removes the sidecar buffers (.bin) and return value side files (.expected) that no data file mentions anymore"""
+    filenames = os.listdir(subdir)
+    contents = []
+    for filename in filenames:
+        if filename.endswith('.json'):
+            with open(os.path.join(subdir, filename)) as f:
+                contents.append(f.read())
+    contents = '\n'.join(contents)
+    for filename in filenames:
+        digest, extension = os.path.splitext(filename)
+        # side files are named after the digest kept in the data files
+        if extension in ('.bin', '.expected') and digest not in contents:
+            logger.debug(f'Removing {os.path.join(subdir, filename)}, no case uses it anymore')
+            os.remove(os.path.join(subdir, filename))
+
+
+def minimise(dry_run=False):
+    import asyncio
+
+    path_list = get_data_file_paths()
+    loaded = load_test_cases(path_list)
+    filenames = set()
+    for test_cases in loaded.values():
+        filenames.update(get_source_filename(x[0]) for x in test_cases)
+    filenames.discard(None)
+
+    loop = asyncio.new_event_loop()
+    cases = []
+    try:
+        for data_file_path, test_cases in loaded.items():
+            cases.extend(measure_test_cases(data_file_path, test_cases, filenames, loop))
+    finally:
+        loop.close()
+
+    selected = select_cases(cases)
+    duration_before = sum(case.duration or 0 for case in cases)
+    duration_after = sum(case.duration or 0 for case in selected)
+    logger.info(
+        f'Keeping {len(selected)} of {len(cases)} test cases, replay time {duration_before:.4f}s -> {duration_after:.4f}s'
+    )
+    if dry_run:
+        return selected
+
+    indices_per_file = {data_file_path: set() for data_file_path in loaded}
+    for case in selected:
+        indices_per_file[case.data_file_path].add(case.index)
+    rewritten_subdirs = set()
+    for data_file_path, indices in indices_per_file.items():
+        if rewrite_data_file(data_file_path, indices):
+            rewritten_subdirs.add(os.path.dirname(data_file_path))
+    for subdir in sorted(rewritten_subdirs):
+        remove_unreferenced_side_files(subdir)
+    return selected
@@ -1,34 +1,62 @@
+import contextlib
 import functools
 import inspect
+import itertools
 import os
 import sys
+import time
 from fnmatch import fnmatch
 from os.path import abspath
-from threading import Thread
+from threading import Thread, Event, Lock
+from types import GeneratorType
 from typing import List, Dict
 
 from loguru import logger
 
 from pytest_cleanup.common import (
     get_test_data_filename,
+    get_test_data_subdir,
+    get_source_hash,
+    get_dependency_hashes,
     get_name,
     get_class_that_defined_method,
     mergeFunctionMetadata,
     log_level,
     is_async_fn,
     is_regular_function,
+    is_function,
     try_dump_dill,
+    memoised_dill_dumps,
+    encode_canonical,
+    get_digest,
+    ReturnValueDigest,
+    GeneratorPrefix,
+    record_generator,
     pytestcleanup_decorated_with_record_test_data,
 )
-from pytest_cleanup.constants import test_data_directory, filename_count_limit, test_filename, test_directory
+from pytest_cleanup import constants
+from pytest_cleanup.constants import filename_count_limit, test_filename
+from pytest_cleanup.sidecar import externalise_buffers, get_sidecar_buffers
 
 user_function = os.environ.get('PYTESTCLEANUP_FUNCTION', 'main')
 invocation_limit_per_function = int(os.environ.get('PYTESTCLEANUP_TEST_CASE_COUNT_PER_FUNCTION', '5'))
+# a share of the per-function limit, so that one signature can't take all of it
+invocation_limit_per_signature = int(
+    os.environ.get('PYTESTCLEANUP_TEST_CASE_COUNT_PER_SIGNATURE', str(max(1, invocation_limit_per_function // 2)))
+)
 serialisation_depth = int(os.environ.get('PYTESTCLEANUP_SERIALISATION_DEPTH', '500'))
 filesize_limit = int(os.environ.get('PYTESTCLEANUP_FILESIZE_LIMIT_MB', '5')) * 1024 * 1024
 allow_all_modules = 'PYTESTCLEANUP_ALLOW_ALL_MODULES' in os.environ
 include_modules = os.environ.get('PYTESTCLEANUP_INCLUDE_MODULES', '').split(',')
 exclude_modules = os.environ.get('PYTESTCLEANUP_EXCLUDE_MODULES', '').split(',')
+record_saturated_functions = 'PYTESTCLEANUP_RECORD_SATURATED_FUNCTIONS' in os.environ
+case_selection = os.environ.get('PYTESTCLEANUP_CASE_SELECTION', 'first')
+digest_threshold = int(os.environ.get('PYTESTCLEANUP_DIGEST_THRESHOLD_KB', '0')) * 1024
+keep_digested_values = 'PYTESTCLEANUP_DIGEST_KEEP_VALUES' in os.environ
+flush_interval = os.environ.get('PYTESTCLEANUP_FLUSH_INTERVAL_SECONDS')
+flush_signal = os.environ.get('PYTESTCLEANUP_FLUSH_SIGNAL', 'SIGUSR1')
+pending_invocation_limit = int(os.environ.get('PYTESTCLEANUP_PENDING_INVOCATION_LIMIT', '100'))
+overhead_budget = float(os.environ.get('PYTESTCLEANUP_OVERHEAD_BUDGET_MS', '0')) / 1000
 
 
 # TODO: did not handle _dynamic_level from loguru properly
@@ -65,17 +93,150 @@ def log_error(f):
     return wrapper
 
 
-def group_by_function(invocations: List) -> Dict[object, List]:
-    result = {}
+def group_by_function(invocations: List, retained: Dict[object, List] = None) -> Dict[object, List]:
+    """`retained` are the invocations already kept in previous calls, they count towards the limits"""
+    result = {f: list(cases) for f, cases in (retained or {}).items()}
+    invocations_by_function = {}
     for invocation in invocations:
         f = invocation['f']
-        if f not in result:
-            result[f] = []
-        if len(result[f]) >= invocation_limit_per_function:
+        if len(result.get(f, ())) >= invocation_limit_per_function:
+            continue
+        return_value = invocation['return_value']
+        if isinstance(return_value, GeneratorPrefix) and return_value.is_unobserved():
+            # the caller didn't consume the generator, the case would pass whatever it yields
+            continue
+        invocations_by_function.setdefault(f, []).append(invocation)
+
+    for f, f_invocations in invocations_by_function.items():
+        cases = result.setdefault(f, [])
+        covered_lines = set()
+        signature_counts = {}
+        for case in cases:
+            covered_lines.update(case.get('coverage') or ())
+            signature = case.get('signature')
+            signature_counts[signature] = signature_counts.get(signature, 0) + 1
+        for invocation in interleave_signatures(f_invocations):
+            if len(cases) >= invocation_limit_per_function:
+                break
+            signature = invocation.get('signature')
+            if signature_counts.get(signature, 0) >= invocation_limit_per_signature:
+                continue
+            if any(are_cases_equal(invocation, x) for x in cases):
+                continue
+            if case_selection == 'coverage' and not adds_coverage(invocation, cases, covered_lines):
+                logger.trace(f'Invocation of {f} does not cover new lines; skipping it')
+                continue
+            cases.append(invocation)
+            signature_counts[signature] = signature_counts.get(signature, 0) + 1
+    return result
+
+
+def get_type_shape(value):
+    value_type = type(value)
+    if value_type in (list, tuple, dict, set, str, bytes):
+        # empty values are a typical edge case
+        return value_type, not value
+    return value_type
+
+
+def get_type_signature(args, kwargs):
+    """Cheap shape of a call's arguments, invocations with different shapes are likely to take different paths"""
+    return tuple(map(get_type_shape, args)), tuple((k, get_type_shape(v)) for k, v in sorted(kwargs.items()))
+
+
+def interleave_signatures(invocations):
+    """
+    Orders invocations round-robin across their type signatures, i.e the first invocation of each signature comes first,
+    so that rare signatures are kept even if more frequent ones would fill the limit on their own
+    """
+    by_signature = {}
+    for invocation in invocations:
+        by_signature.setdefault(invocation.get('signature'), []).append(invocation)
+    if len(by_signature) == 1:
+        return invocations
+    rounds = itertools.zip_longest(*by_signature.values())
+    return [invocation for invocation in itertools.chain.from_iterable(rounds) if invocation is not None]
+
+
+def adds_coverage(invocation, cases, covered_lines):
+    lines = invocation.get('coverage')
+    if lines is None:
+        # coverage could not be collected for this call
+        return True
+    new_lines = lines - covered_lines
+    if not new_lines and cases:
+        return False
+    covered_lines.update(new_lines)
+    return True
+
+
+def measure_coverage(f):
+    if case_selection != 'coverage':
+        return contextlib.nullcontext()
+    from pytest_cleanup.tracing import LineCoverage
+
+    code = getattr(f, '__code__', None)
+    return LineCoverage({code.co_filename} if code else None)
+
+
+def get_encoded_type_shape(value):
+    """get_type_shape of a value as jsonpickle encoded it, without decoding it"""
+    if isinstance(value, dict):
+        for key in ('py/object', 'py/type', 'py/function'):
+            if key in value:
+                return key, value[key]
+        for key in ('py/tuple', 'py/set'):
+            if key in value:
+                return key, not value[key]
+        return 'dict', not value
+    if isinstance(value, (list, str)):
+        return type(value).__name__, not value
+    return type(value).__name__
+
+
+def get_encoded_type_signature(test_case):
+    args = test_case.get('args')
+    args = args.get('py/tuple', []) if isinstance(args, dict) else []
+    kwargs = test_case.get('kwargs')
+    kwargs = sorted(kwargs.items()) if isinstance(kwargs, dict) else []
+    return tuple(map(get_encoded_type_shape, args)), tuple((k, get_encoded_type_shape(v)) for k, v in kwargs)
+
+
+def get_saturated_functions():
+    """
+    Finds functions that already have enough test cases on disk: as many as the per-function limit,
+    or as many as the per-signature limit for each of the signatures they were called with.
+    Returns a dict of test data subdirectory -> source hashes for which the case count limit is reached.
+    """
+    import json
+    from glob import glob
+
+    sep = os.sep
+    case_counts = {}
+    for data_file_path in glob(f'{constants.test_data_directory}{sep}*{sep}**{sep}*.json', recursive=True):
+        try:
+            with open(data_file_path) as f:
+                data = json.load(f)
+        except Exception as e:
+            logger.warning(f'Could not read data file {data_file_path}: {e}')
             continue
-        if invocation in result[f]:
+        source_hash = data.get('source_hash')
+        if not source_hash:
+            # written before source hashes were recorded, can't tell if the function changed since
             continue
-        result[f].append(invocation)
+        subdir = os.path.relpath(os.path.dirname(data_file_path), constants.test_data_directory).replace(sep, '/')
+        signature_counts = case_counts.setdefault((subdir, source_hash), {})
+        for test_case in data.get('test_cases') or []:
+            signature = get_encoded_type_signature(test_case) if isinstance(test_case, dict) else None
+            signature_counts[signature] = signature_counts.get(signature, 0) + 1
+
+    result = {}
+    for (subdir, source_hash), signature_counts in case_counts.items():
+        count = sum(signature_counts.values())
+        if count >= invocation_limit_per_function or (
+            signature_counts and min(signature_counts.values()) >= invocation_limit_per_signature
+        ):
+            result.setdefault(subdir, set()).add(source_hash)
     return result
 
 
@@ -149,32 +310,42 @@ def singleton(cls):
 def save_example_scripts():
     runtime_script = 'conftest-pytest-cleanup-runtime.py'
     record_script = 'conftest-pytest-cleanup-record.py'
-    logger.debug(f'Saving example scripts ({test_filename}, {runtime_script}, {record_script}) under {test_directory}')
-    with open(f'{test_directory}/{test_filename}', 'w') as f:
+    logger.debug(
+        f'Saving example scripts ({test_filename}, {runtime_script}, {record_script}) under {constants.test_directory}'
+    )
+    with open(f'{constants.test_directory}/{test_filename}', 'w') as f:
         f.write(
             f"""import pytest
 
-from pytest_cleanup.common import assert_return_values
+from pytest_cleanup.common import assert_return_values, latency_budget
 
 
-def test_pytest_cleanup_sync_test_cases(fn, args, kwargs, expected):
-    ""\"See {test_data_directory} directory for test cases\"""
-    actual = fn(*args, **kwargs)
+def test_pytest_cleanup_sync_test_cases(fn, args, kwargs, expected, duration):
+    ""\"See {constants.test_data_directory} directory for test cases\"""
+    with latency_budget(duration):
+        actual = fn(*args, **kwargs)
     assert_return_values(actual, expected)
 
 
 @pytest.mark.asyncio
-async def test_pytest_cleanup_async_test_cases(fn, args, kwargs, expected):
-    ""\"See {test_data_directory} directory for test cases.
+async def test_pytest_cleanup_async_test_cases(fn, args, kwargs, expected, duration):
+    ""\"See {constants.test_data_directory} directory for test cases.
     support for asyncio in pytest may be enabled by installing pytest-asyncio \"""
-    actual = await fn(*args, **kwargs)
+    with latency_budget(duration):
+        actual = await fn(*args, **kwargs)
     assert_return_values(actual, expected)
 """
         )
 
-    with open(f'{test_directory}/{runtime_script}', 'w') as f:
+    with open(f'{constants.test_directory}/{runtime_script}', 'w') as f:
         f.write(
-            f"""def pytest_generate_tests(metafunc):
+            f"""def pytest_addoption(parser):
+    from pytest_cleanup import add_pytest_options
+
+    add_pytest_options(parser)
+
+
+def pytest_generate_tests(metafunc):
     from pytest_cleanup import parametrize_stg_tests
 
     parametrize_stg_tests(metafunc)
@@ -183,7 +354,7 @@ async def test_pytest_cleanup_async_test_cases(fn, args, kwargs, expected):
 """
         )
 
-    with open(f'{test_directory}/{record_script}', 'w') as f:
+    with open(f'{constants.test_directory}/{record_script}', 'w') as f:
         f.write(
             f"""from pytest_cleanup import Recorder
 
@@ -244,10 +415,44 @@ class Recorder:
     def __init__(self):
         logger.info('creating instance of recorder')
         self.invocations = []
-
-    def add_invocation(self, return_value, f, args, kwargs):
-        i = {'return_value': return_value, 'f': f, 'args': args, 'kwargs': kwargs}
-        self.invocations.append(i)
+        self.saturated_functions = {}
+        # invocations already saved to data files, by function
+        self.retained = {}
+        self.pending_counts = {}
+        self.invocations_lock = Lock()
+        self.flush_lock = Lock()
+        self.flush_requested = Event()
+        self.flush_stopped = Event()
+        self.flush_thread = None
+        self.previous_signal_handler = None
+        # (owner, attribute name, original) of each module or class attribute replaced by a wrapper, by function
+        self.patch_sites = {}
+        # [call count, wrapper overhead in seconds, overhead of the next check] by function
+        self.overheads = {}
+        self.recording_started = None
+
+    def add_invocation(self, return_value, f, args, kwargs, coverage=None, duration=None):
+        if len(self.retained.get(f, ())) >= invocation_limit_per_function:
+            return
+        i = {
+            'return_value': return_value,
+            'f': f,
+            'args': args,
+            'kwargs': kwargs,
+            'duration': duration,
+            'signature': get_type_signature(args, kwargs),
+        }
+        if coverage is not None:
+            i['coverage'] = coverage.lines
+        with self.invocations_lock:
+            if self.flush_thread:
+                # bound memory use between flushes, per signature so that rare ones still get a chance
+                key = (f, i['signature'])
+                count = self.pending_counts.get(key, 0)
+                if count >= pending_invocation_limit:
+                    return
+                self.pending_counts[key] = count + 1
+            self.invocations.append(i)
 
     def __enter__(self):
         self.enter()
@@ -266,8 +471,12 @@ class Recorder:
             if fn_name.startswith('pytest_') and fn.__module__ == 'conftest' or fn.__module__.endswith('.conftest'):
                 logger.log(log_level, f'skipping pytest function {fn} in conftest')
                 continue
+            if self.is_saturated(fn.__module__, None, fn):
+                logger.log(log_level, f'skipping {fn}, it already has enough test cases and did not change')
+                continue
             logger.log(log_level, f'editing {fn_name} {module} ({fn.__module__}.{fn.__name__})')
             new_item = mergeFunctionMetadata(fn, self.record_test_data(fn))
+            self.patch_sites.setdefault(fn, []).append((module, fn.__name__, fn))
             setattr(module, fn.__name__, new_item)
 
     def record_test_data(self, f):
@@ -285,9 +494,13 @@ class Recorder:
             arg_signature = argspec.args
             is_cls_function = clazz and arg_signature and arg_signature[0] == 'cls'
 
+        def is_class_argument(arg):
+            return isinstance(arg, clazz) or isinstance(arg, type) and issubclass(arg, clazz)
+
         def edit_args(args):
             if is_cls_function:
-                if len(args) and not isinstance(list(args)[0], clazz):
+                # classmethods are passed their class, functions with a cls argument may not be
+                if len(args) and not is_class_argument(list(args)[0]):
                     args = add_class_object_as_arg(args)
                 elif not len(args):
                     args = tuple([clazz] + list(args))
@@ -295,10 +508,19 @@ class Recorder:
 
         @functools.wraps(f)
         def sync_wrapper(*args, **kwargs):
+            wrapper_start = time.perf_counter()
             logger.log(log_level, f'wrapped {f}')
             args = edit_args(args)
             try:
-                return_value = f(*args, **kwargs)
+                with measure_coverage(f) as coverage:
+                    start = time.perf_counter()
+                    return_value = f(*args, **kwargs)
+                    elapsed = time.perf_counter() - start
+                # line tracing slows the call down, its duration wouldn't be the one of the bare call
+                duration = None if coverage and coverage.lines is not None else elapsed
+                recorded_value = return_value
+                if isinstance(return_value, GeneratorType):
+                    recorded_value, return_value = record_generator(return_value)
             except (KeyError, ModuleNotFoundError, TypeError, AttributeError) as e:
                 # e.g KeyError: 'tkinter'
                 # e.g ModuleNotFoundError: No module named 'tkinter'
@@ -309,15 +531,26 @@ class Recorder:
                 logger.exception(e)
                 return
 
-            this.add_invocation(return_value, f, args, kwargs)
+            this.add_invocation(recorded_value, f, args, kwargs, coverage, duration)
+            if overhead_budget:
+                this.track_overhead(f, time.perf_counter() - wrapper_start - elapsed)
             return return_value
 
         @functools.wraps(f)
         async def async_wrapper(*args, **kwargs):
+            wrapper_start = time.perf_counter()
             # logger.trace(f'wrapped {f}')
             args = edit_args(args)
             try:
-                return_value = await f(*args, **kwargs)
+                with measure_coverage(f) as coverage:
+                    start = time.perf_counter()
+                    return_value = await f(*args, **kwargs)
+                    elapsed = time.perf_counter() - start
+                # line tracing slows the call down, its duration wouldn't be the one of the bare call
+                duration = None if coverage and coverage.lines is not None else elapsed
+                recorded_value = return_value
+                if isinstance(return_value, GeneratorType):
+                    recorded_value, return_value = record_generator(return_value)
             except (KeyError, ModuleNotFoundError, TypeError, AttributeError) as e:
                 # e.g KeyError: 'tkinter'
                 # e.g ModuleNotFoundError: No module named 'tkinter'
@@ -328,7 +561,9 @@ class Recorder:
                 logger.exception(e)
                 return
 
-            this.add_invocation(return_value, f, args, kwargs)
+            this.add_invocation(recorded_value, f, args, kwargs, coverage, duration)
+            if overhead_budget:
+                this.track_overhead(f, time.perf_counter() - wrapper_start - elapsed)
             return return_value
 
         def add_class_object_as_arg(args):
@@ -338,12 +573,127 @@ class Recorder:
         wrapper.pytestcleanup_decorated_with_record_test_data = True
         return wrapper
 
-    def enter(self):
+    def track_overhead(self, f, overhead):
+        """
+        Restores the original of `f` once its wrapper overhead is over budget, if it already has enough cases:
+        either as many as allowed, or no new one was selected since the last check, e.g in coverage mode.
+        """
+        stats = self.overheads.get(f)
+        if stats is None:
+            # calls, total overhead, overhead of the next check, case count at the last check
+            stats = self.overheads[f] = [0, 0.0, overhead_budget, None]
+        stats[0] += 1
+        stats[1] += overhead
+        if stats[1] < stats[2]:
+            return
+        # checking the cases scans the pending invocations, so it's only done each time the overhead doubles
+        stats[2] *= 2
+        case_count = self.count_cases(f)
+        if case_count >= invocation_limit_per_function or case_count == stats[3]:
+            self.demote(f)
+        stats[3] = case_count
+
+    def count_cases(self, f):
+        with self.invocations_lock:
+            invocations = [x for x in self.invocations if x['f'] is f]
+        retained = {f: self.retained[f]} if f in self.retained else None
+        return len(group_by_function(invocations, retained).get(f, ()))
+
+    def demote(self, f):
+        sites = self.patch_sites.pop(f, None)
+        if not sites:
+            # already demoted, but some callers kept a reference to a wrapper
+            return
+        for owner, name, original in sites:
+            setattr(owner, name, original)
+        calls, overhead, *_ = self.overheads[f]
+        elapsed = time.perf_counter() - (self.recording_started or 0)
+        logger.info(
+            f'Stopped recording {fn_description(f)}: its wrapper added {overhead * 1000:.1f} ms over {calls} calls '
+            f'({calls / elapsed:.0f} calls/s), over the {overhead_budget * 1000:g} ms budget'
+        )
+
+    def is_saturated(self, module_name, clazz, fn):
+        subdir = get_test_data_subdir(module_name, clazz, get_name(fn))
+        source_hashes = self.saturated_functions.get(subdir)
+        return bool(source_hashes) and get_source_hash(fn) in source_hashes
+
+    def enter(self, saturated_functions=None):
+        """`saturated_functions` as returned by get_saturated_functions, looked up in the test data directory if None"""
+        if saturated_functions is not None:
+            self.saturated_functions = saturated_functions
+        elif not record_saturated_functions:
+            self.saturated_functions = get_saturated_functions()
         self.edit_module_level_functions()
         self.edit_module_level_classes()
         logger.log(log_level, 'Start recording invocations')
+        self.recording_started = time.perf_counter()
+        if flush_interval is not None:
+            self.start_flushing(float(flush_interval) or None)
+
+    def start_flushing(self, interval):
+        """Service mode: saves new test cases every `interval` seconds, or when receiving `flush_signal`"""
+        import signal
+        import threading
+
+        if threading.current_thread() is threading.main_thread() and hasattr(signal, flush_signal):
+            signum = getattr(signal, flush_signal)
+            self.previous_signal_handler = (signum, signal.signal(signum, self.request_flush))
+        self.flush_stopped.clear()
+        self.flush_thread = Thread(
+            target=self.flush_periodically, args=(interval,), name='pytest_cleanup-flush', daemon=True
+        )
+        self.flush_thread.start()
+        logger.info(f'Flushing test cases every {interval}s or on {flush_signal}')
+
+    def request_flush(self, *args):
+        # only wakes the flush thread, flushing from a signal handler could deadlock
+        self.flush_requested.set()
+
+    def flush_periodically(self, interval):
+        while not self.flush_stopped.is_set():
+            self.flush_requested.wait(interval)
+            self.flush_requested.clear()
+            if self.flush_stopped.is_set():
+                break
+            try:
+                self.flush()
+            except Exception as e:
+                logger.exception(e)
+
+    def stop_flushing(self):
+        if not self.flush_thread:
+            return
+        self.flush_stopped.set()
+        self.flush_requested.set()
+        self.flush_thread.join()
+        self.flush_thread = None
+        if self.previous_signal_handler:
+            import signal
+
+            signum, handler = self.previous_signal_handler
+            signal.signal(signum, handler)
+            self.previous_signal_handler = None
+
+    def flush(self):
+        """Saves the test cases recorded since the previous flush"""
+        with self.flush_lock:
+            with self.invocations_lock:
+                invocations, self.invocations = self.invocations, []
+                self.pending_counts = {}
+            invocation_group = group_by_function(invocations, self.retained)
+            new_invocation_group = {}
+            for f, cases in invocation_group.items():
+                new_cases = cases[len(self.retained.get(f, ())) :]
+                if new_cases:
+                    new_invocation_group[f] = new_cases
+            self.retained = invocation_group
+            print_invocation_group_summary(new_invocation_group)
+            self.save_test_data(new_invocation_group)
 
     def edit_module_level_classes(self):
+        # ids of classes already edited, as a class may be imported in many modules
+        visited = set()
         for name, module in get_loaded_modules():
             logger.log(log_level, f'loading {name}')
             if not self.is_module_allowed(module):
@@ -354,19 +704,24 @@ class Recorder:
                 logger.warning(f'Failed getting members for module {module}, skipping')
                 logger.error(e)
                 continue
-            # TODO: patch parent class methods
-            # TODO: what if a module imported a class from another module?
 
             for class_name, clazz in classes:
-                # clazz = class_tuple[1]
-                if clazz == self.__class__:
+                if id(clazz) in visited:
                     continue
                 if issubclass(clazz, Thread):
                     logger.log(log_level, 'skipping thread classes')
+                    visited.add(id(clazz))
                     continue
-                if not self.is_module_allowed(get_module(clazz.__module__)):
-                    continue
-                self.edit_class_function(class_name, clazz)
+                # inherited methods are edited in the class that defines them
+                for parent in inspect.getmro(clazz):
+                    if id(parent) in visited:
+                        continue
+                    visited.add(id(parent))
+                    if parent == self.__class__:
+                        continue
+                    if not self.is_module_allowed(get_module(parent.__module__)):
+                        continue
+                    self.edit_class_function(parent.__name__, parent)
 
     def edit_class_function(self, class_name, clazz):
         fn_name: str
@@ -383,20 +738,28 @@ class Recorder:
                 logger.log(log_level, f'Skipping test function in class {clazz}')
                 continue
             logger.log(log_level, f'editing {get_module(clazz.__module__)}.{class_name}.{fn_name}')
-            if not hasattr(fn, '__name__') and hasattr(fn, '__func__'):
-                # logger.log(log_level, dir(fn.__func__))
+            original = fn
+            if isinstance(fn, (staticmethod, classmethod)) or (not hasattr(fn, '__name__') and hasattr(fn, '__func__')):
+                # staticmethod and classmethod objects also have a __name__ since python 3.10
                 fn = fn.__func__
+            if self.is_saturated(clazz.__module__, clazz, fn):
+                logger.log(log_level, f'skipping {fn}, it already has enough test cases and did not change')
+                continue
             try:
                 new_item = mergeFunctionMetadata(fn, self.record_test_data(fn))
             except Exception as e:
                 logger.error(e)
                 raise  # continue
             # TODO: if not being able to recreate method properly, can check how boto3 does it
+            if isinstance(original, (staticmethod, classmethod)):
+                # so that the wrapper is called without the instance, or with the class
+                new_item = type(original)(new_item)
             try:
                 setattr(clazz, fn_name, new_item)
             except Exception as e:
                 logger.error(e)
                 continue
+            self.patch_sites.setdefault(fn, []).append((clazz, fn_name, original))
 
     def edit_module_level_functions(self):
         for name, module in get_loaded_modules():
@@ -431,7 +794,7 @@ class Recorder:
         if allow_all_modules:
             return True
         module_name = get_name(module)
-        if module_name == '__main__':
+        if module_name in ('__main__', '__mp_main__'):
             logger.log(log_level, 'Skipping __main__ module as main module will be a different one at run time')
             return
         if self.is_module_explicitly_disallowed(module_name):
@@ -463,14 +826,18 @@ class Recorder:
             return
         return True
 
-    def exit(self):
+    def exit(self, save_scripts=True):
+        self.stop_flushing()
         logger.log(log_level, f'Stopped recording invocations, got {len(self.invocations)} of them.')
-        invocation_group = group_by_function(self.invocations)
-        print_invocation_group_summary(invocation_group)
-        save_example_scripts()
-        self.save_test_data(invocation_group)
+        if save_scripts:
+            save_example_scripts()
+        self.flush()
 
     def save_test_data(self, invocation_group):
+        with memoised_dill_dumps():
+            self.save_functions_test_data(invocation_group)
+
+    def save_functions_test_data(self, invocation_group):
         for fn, invocations in invocation_group.items():
             module = inspect.getmodule(fn)
             if not self.is_module_allowed(module):
@@ -483,27 +850,58 @@ class Recorder:
 
             test_cases = [
                 {
-                    'args': try_dump_dill(x['args']),
-                    'kwargs': try_dump_dill(x['kwargs']),
-                    'return_value': try_dump_dill(x['return_value']),
+                    # buffers first, so that large dill payloads aren't mistaken for them
+                    'args': try_dump_dill(externalise_buffers(x['args'])),
+                    'kwargs': try_dump_dill(externalise_buffers(x['kwargs'])),
+                    'return_value': digest_large_return_value(try_dump_dill(externalise_buffers(x['return_value']))),
+                    'duration': x['duration'],
                 }
                 for x in invocations
             ]
             test_cases = remove_duplicate_cases(test_cases)
-            write_data_file(module_name, module, clazz, fn, test_cases)
+            dependency_hashes = get_dependency_hashes(fn, self.is_module_allowed)
+            write_data_file(module_name, module, clazz, fn, test_cases, dependency_hashes)
+
+
+def digest_large_return_value(return_value):
+    if (
+        not digest_threshold
+        or is_function(return_value)
+        or isinstance(return_value, (bytes, GeneratorPrefix))
+        # their digest would be of the placeholders, not of the actual buffers
+        or get_sidecar_buffers(return_value)
+    ):
+        return return_value
+    encoded = encode_canonical(return_value)
+    if encoded is None or len(encoded) <= digest_threshold:
+        return return_value
+    logger.log(log_level, f'Return value is {len(encoded)} bytes long, only saving its digest')
+    return ReturnValueDigest(get_digest(encoded), encoded if keep_digested_values else None)
+
+
+def write_side_files(subdir, test_cases):
+    directory = os.path.join(constants.test_data_directory, subdir)
+    for test_case in test_cases:
+        for buffer in get_sidecar_buffers((test_case['args'], test_case['kwargs'], test_case['return_value'])):
+            buffer.save(directory)
+        return_value = test_case['return_value']
+        if not isinstance(return_value, ReturnValueDigest) or not return_value.encoded:
+            continue
+        with open(return_value.get_side_filename(directory), 'w') as f:
+            f.write(return_value.encoded)
 
 
 @log_error
-def write_data_file(module_name, module, clazz, fn, test_cases):
+def write_data_file(module_name, module, clazz, fn, test_cases, dependency_hashes=None):
     function_name = fn.__name__
     if not test_cases:
         return
-    class_or_module_name = get_name(clazz) or module_name
-    subdir = f'{module_name}/{class_or_module_name}/{function_name}'
+    subdir = get_test_data_subdir(module_name, clazz, function_name)
     create_directory(subdir)
+    write_side_files(subdir, test_cases)
 
     success = False
-    contents = serialise(module, clazz, fn, test_cases)
+    contents = serialise(module, clazz, fn, test_cases, dependency_hashes)
     if len(contents) > filesize_limit:
         logger.log(log_level, 'Content is bigger than configured filesize limit')
         return
@@ -524,16 +922,24 @@ def write_data_file(module_name, module, clazz, fn, test_cases):
         )
 
 
-def serialise(module, clazz, fn, test_cases):
-    return serialise_json(module, clazz, fn, test_cases)
+def serialise(module, clazz, fn, test_cases, dependency_hashes=None):
+    return serialise_json(module, clazz, fn, test_cases, dependency_hashes)
 
 
-def serialise_json(module, clazz, fn, test_cases):
+def serialise_json(module, clazz, fn, test_cases, dependency_hashes=None):
     import jsonpickle
     import json
 
     encoded = jsonpickle.encode(
-        {'test_cases': test_cases, 'class': clazz, 'module': module, 'function': fn}, max_depth=serialisation_depth
+        {
+            'test_cases': test_cases,
+            'class': clazz,
+            'module': module,
+            'function': fn,
+            'source_hash': get_source_hash(fn),
+            'dependency_hashes': dependency_hashes or {},
+        },
+        max_depth=serialisation_depth,
     )
     # loads/dumps is a terrible workaround to pretty print the json
     pretty = json.dumps(json.loads(encoded), indent=2, sort_keys=True)
@@ -544,6 +950,6 @@ def create_directory(sub_dir):
     from os import makedirs
 
     try:
-        makedirs(os.path.join(test_data_directory, sub_dir))
+        makedirs(os.path.join(constants.test_data_directory, sub_dir))
     except Exception as e:
         logger.log(log_level, e)
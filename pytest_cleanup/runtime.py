@@ -1,12 +1,12 @@
 import functools
 import inspect
+import itertools
 import os
 from glob import glob
 from random import shuffle
 from types import GeneratorType
-from typing import TextIO
+from typing import TextIO, TYPE_CHECKING
 
-from _pytest.python import Metafunc
 from loguru import logger
 
 from pytest_cleanup.common import (
@@ -16,8 +16,30 @@ from pytest_cleanup.common import (
     try_load_dill,
     pytestcleanup_decorated_with_record_test_data,
     get_name,
+    get_source_hash,
+    get_module_source_hash,
+    ReturnValueDigest,
+    GeneratorPrefix,
+    generator_item_limit,
+    assert_return_values,
+    latency_budget,
+    latency_budget_multiple,
 )
-from pytest_cleanup.constants import test_data_directory
+from pytest_cleanup import constants
+from pytest_cleanup.sidecar import load_buffers
+
+if TYPE_CHECKING:
+    from _pytest.python import Metafunc
+
+batch_async_cases = 'PYTESTCLEANUP_BATCH_ASYNC_CASES' in os.environ
+batch_data_files = 'PYTESTCLEANUP_BATCH_DATA_FILES' in os.environ
+async_concurrency = int(os.environ.get('PYTESTCLEANUP_ASYNC_CONCURRENCY', '10'))
+changed_only = 'PYTESTCLEANUP_CHANGED_ONLY' in os.environ
+collection_workers = int(os.environ.get('PYTESTCLEANUP_COLLECTION_WORKERS', '1'))
+collection_executor = os.environ.get('PYTESTCLEANUP_COLLECTION_EXECUTOR', 'thread')
+collection_cache_key = 'pytest_cleanup/collection'
+# bump this when what the collection cache keeps changes
+collection_cache_format = 4
 
 
 def deserialise(f):
@@ -45,13 +67,13 @@ def transform_function(f):
     def wrapper(*args, **kwargs):
         if is_cls_function:
             first_arg_is_cls = len(args) and not isinstance(list(args)[0], clazz) or not len(args)
+            if first_arg_is_cls and args and isinstance(args[0], type) and hasattr(f, '__func__'):
+                # called with the recorded class, which may be a subclass of the one defining the method
+                return f.__func__(*args, **kwargs)
             if first_arg_is_cls:
                 args = remove_first_argument(args)
-        return_value = f(*args, **kwargs)
-        if isinstance(return_value, GeneratorType):
-            # generators aren't really comparable, so we compare lists instead
-            return list(return_value)
-        return return_value
+        # generators are returned as is, assert_return_values consumes them lazily
+        return f(*args, **kwargs)
 
     def remove_first_argument(args):
         return tuple(list(args)[1:])
@@ -69,12 +91,72 @@ def deserialise_from_file(filename):
             logger.error(e)
 
 
-def load_data_file(filename, is_async):
-    data = deserialise_from_file(filename)
+def parse_data_file(filename):
+    """
+    The json of a data file, without decoding it, i.e without importing or creating the objects it refers to.
+    Runs in worker processes: plain json is cheap to send back, unlike modules and functions.
+    """
+    import json
+
+    try:
+        with open(filename, 'r') as f:
+            return json.load(f)
+    except Exception as e:
+        return e
+
+
+def deserialise_parsed(filename, parsed):
+    """Decodes the result of parse_data_file, like deserialise_from_file"""
+    from jsonpickle.unpickler import Unpickler
+
+    try:
+        if isinstance(parsed, Exception):
+            raise parsed
+        return Unpickler().restore(parsed, reset=True)
+    except Exception as e:
+        logger.error(f'Error loading data file {filename}')
+        logger.error(e)
+
+
+def load_data_file(filename, is_async=None, only_changed=False, collection_cache=None):
+    """
+    is_async filters out data files of sync or async functions, None loads both.
+    only_changed filters out data files whose function and dependencies did not change since they were recorded.
+    """
+    data = collection_cache.decode(filename) if collection_cache else deserialise_from_file(filename)
+    return load_test_cases(filename, data, is_async, only_changed)
+
+
+def has_changed(fn, data):
+    source_hash = data.get('source_hash')
+    if not source_hash or get_source_hash(fn) != source_hash:
+        return True
+    import importlib
+
+    for key, dependency_hash in (data.get('dependency_hashes') or {}).items():
+        # module:qualname for functions and classes, module names for whole modules
+        module_name, _, qualname = key.partition(':')
+        try:
+            module = importlib.import_module(module_name)
+        except Exception:
+            return True
+        if not qualname:
+            if get_module_source_hash(module) != dependency_hash:
+                return True
+            continue
+        value = module
+        for name in qualname.split('.'):
+            value = getattr(value, name, None)
+        if value is None or get_source_hash(value) != dependency_hash:
+            return True
+    return False
+
+
+def load_test_cases(filename, data, is_async, only_changed=False):
     if not data:
         return
     fn = data['function']
-    if (is_async and not is_async_fn(fn)) or (not is_async and is_async_fn(fn)):
+    if is_async is not None and is_async != is_async_fn(fn):
         return
     if not fn:
         logger.warning(f'Function was not properly loaded from {filename}')
@@ -89,58 +171,382 @@ def load_data_file(filename, is_async):
         return
         # raise Exception(f'no class or module found for {filename}')
     fn = getattr(class_or_module, function_name)
+    if only_changed and not has_changed(fn, data):
+        logger.debug(f'Skipping {filename}, its function did not change')
+        return
     new_item = mergeFunctionMetadata(fn, transform_function(fn))
+    directory = os.path.dirname(filename)
 
     return (
         module,
         clazz,
         [
-            (new_item, try_load_dill(x['args']), try_load_dill(x['kwargs']), edit_return_value(x['return_value']))
+            (
+                new_item,
+                load_buffers(try_load_dill(x['args']), directory),
+                load_buffers(try_load_dill(x['kwargs']), directory),
+                edit_return_value(x['return_value'], directory),
+                x.get('duration'),
+            )
             for x in data['test_cases']
         ],
     )
 
 
-def edit_return_value(return_value):
+def edit_return_value(return_value, directory=None):
     from _collections_abc import list_iterator
 
-    return_value = try_load_dill(return_value)
+    return_value = load_buffers(try_load_dill(return_value), directory)
+
+    if isinstance(return_value, ReturnValueDigest):
+        # side files with the full value are kept next to the data file
+        return_value.directory = directory
 
     if isinstance(return_value, list_iterator):
         # because jsonpickle serialises things like generators as "list iterators"
-        return_value = list(return_value)
+        return_value = GeneratorPrefix.from_iterator(return_value)
     return return_value
 
 
-def parametrize_stg_tests(metafunc: Metafunc):
+def run_test_case(fn, args, kwargs, loop=None):
+    """Calls a loaded test case outside of pytest, running it to completion on `loop` if it's a coroutine"""
+    actual = fn(*args, **kwargs)
+    if inspect.iscoroutine(actual):
+        import asyncio
+
+        actual = (loop or asyncio.get_event_loop()).run_until_complete(actual)
+    if isinstance(actual, GeneratorType):
+        actual = list(itertools.islice(actual, generator_item_limit))
+    return actual
+
+
+class AsyncBatch:
+    """
+    Async test cases that run concurrently on a single event loop, with at most `async_concurrency` at a time.
+    They all run the first time that the result of any of them is needed.
+    """
+
+    def __init__(self):
+        self.test_cases = []
+        self.outcomes = None
+
+    def add(self, fn, args, kwargs):
+        self.test_cases.append((fn, args, kwargs))
+        return BatchedCall(self, len(self.test_cases) - 1)
+
+    def run(self):
+        import asyncio
+
+        if latency_budget_multiple:
+            # running concurrently, each case's elapsed time includes the others', it says nothing of its own latency
+            logger.warning(
+                f'Latency budgets are not applied to the {len(self.test_cases)} async test cases batched with '
+                f'PYTESTCLEANUP_BATCH_ASYNC_CASES'
+            )
+        loop = asyncio.new_event_loop()
+        try:
+            self.outcomes = loop.run_until_complete(self.gather())
+        finally:
+            loop.close()
+
+    async def gather(self):
+        import asyncio
+
+        semaphore = asyncio.Semaphore(async_concurrency)
+
+        async def run_one(fn, args, kwargs):
+            async with semaphore:
+                try:
+                    return True, await fn(*args, **kwargs)
+                except Exception as e:
+                    return False, e
+
+        return await asyncio.gather(*[run_one(*x) for x in self.test_cases])
+
+    def result(self, index):
+        if self.outcomes is None:
+            self.run()
+        succeeded, outcome = self.outcomes[index]
+        if not succeeded:
+            raise outcome
+        return outcome
+
+
+class BatchedCall:
+    """Stands in for an async test case's function in the sync test, returning the result from its batch"""
+
+    def __init__(self, batch, index):
+        self.batch = batch
+        self.index = index
+
+    def __call__(self, *args, **kwargs):
+        return self.batch.result(self.index)
+
+    def __repr__(self):
+        return f'BatchedCall({self.batch.test_cases[self.index][0]})'
+
+
+class DataFileBatch:
+    """
+    Stands in for all the test cases of a data file in the sync test, so that pytest only handles one item per file.
+    Runs every case, including async ones, and fails with all of the mismatches at once.
+    """
+
+    def __init__(self, filename, test_cases):
+        self.filename = filename
+        self.test_cases = test_cases
+
+    def __call__(self, *args, **kwargs):
+        failures = []
+        loop = None
+        if any(is_async_fn(inspect.unwrap(x[0])) for x in self.test_cases):
+            import asyncio
+
+            # created up front, so that async cases are timed like sync ones against their latency budget
+            loop = asyncio.new_event_loop()
+        try:
+            for index, (fn, case_args, case_kwargs, expected, duration) in enumerate(self.test_cases):
+                try:
+                    with latency_budget(duration):
+                        actual = fn(*case_args, **case_kwargs)
+                        if inspect.iscoroutine(actual):
+                            import asyncio
+
+                            loop = loop or asyncio.new_event_loop()
+                            actual = loop.run_until_complete(actual)
+                except Exception as e:
+                    failures.append(f'case {index}: {type(e).__name__}: {e}')
+                    continue
+                try:
+                    assert_return_values(actual, expected)
+                except Exception as e:
+                    failures.append(f'case {index}: {str(e) or f"expected {expected!r}, got {actual!r}"}')
+        finally:
+            if loop:
+                loop.close()
+        if failures:
+            details = '\n'.join(failures)
+            count = len(self.test_cases)
+            raise AssertionError(f'{len(failures)} of {count} cases failed in {self.filename}:\n{details}')
+
+    def __repr__(self):
+        return f'DataFileBatch({self.filename}, {len(self.test_cases)} cases)'
+
+
+def get_data_file_paths():
+    sep = os.sep
+    return list(sorted(glob(f'{constants.test_data_directory}{sep}*{sep}**{sep}*.json', recursive=True)))
+
+
+class CollectionCache:
+    """
+    Keeps whether each data file is of an async function in pytest's cache directory between sessions.
+    Decoded contents aren't cached: they refer to modules, which can't be pickled without copying their globals.
+    Entries are also invalidated when the source file of the function changes, e.g once it's made async.
+    Entries are invalidated when the data file's mtime or size, the cache format or the installed pytest_cleanup version
+    change.
+    """
+
+    def __init__(self, cache=None):
+        self.cache = cache
+        self.entries = cache.get(collection_cache_key, {}) if cache else {}
+        self.changed = False
+        # source filename -> stamp, source files are only looked at once per session
+        self.source_stamps = {}
+
+    @classmethod
+    def from_config(cls, config):
+        # cache is missing if the cacheprovider plugin is disabled, i.e `-p no:cacheprovider`
+        return cls(getattr(config, 'cache', None))
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def get_distribution_version():
+        """None if it isn't installed, e.g running from a checkout"""
+        try:
+            from importlib import metadata
+        except ImportError:
+            # python 3.7
+            try:
+                import pkg_resources
+
+                return pkg_resources.get_distribution('pytest_cleanup').version
+            except Exception:
+                return None
+        try:
+            return metadata.version('pytest_cleanup')
+        except metadata.PackageNotFoundError:
+            return None
+
+    @classmethod
+    def get_stamp(cls, filename):
+        stat = os.stat(filename)
+        return [stat.st_mtime_ns, stat.st_size, collection_cache_format, cls.get_distribution_version()]
+
+    def get_source_stamp(self, source_filename):
+        if source_filename not in self.source_stamps:
+            try:
+                stat = os.stat(source_filename)
+                self.source_stamps[source_filename] = [source_filename, stat.st_mtime_ns, stat.st_size]
+            except OSError:
+                self.source_stamps[source_filename] = None
+        return self.source_stamps[source_filename]
+
+    def get_entry(self, filename):
+        entry = self.entries.get(filename)
+        try:
+            if not entry or entry['stamp'] != self.get_stamp(filename):
+                return None
+        except OSError:
+            return None
+        source = entry.get('source')
+        if source and self.get_source_stamp(source[0]) != source:
+            return None
+        return entry
+
+    def filter(self, path_list, is_async):
+        """Leaves out the data files known to be of the other kind of function, without reading them"""
+        if is_async is None:
+            return path_list
+        result = []
+        for path in path_list:
+            entry = self.get_entry(path)
+            if entry and entry['is_async'] is not None and entry['is_async'] != is_async:
+                continue
+            result.append(path)
+        return result
+
+    def decode(self, filename):
+        data = deserialise_from_file(filename)
+        self.add(filename, data)
+        return data
+
+    def add(self, filename, data):
+        if not self.cache or self.get_entry(filename):
+            return
+        try:
+            stamp = self.get_stamp(filename)
+        except OSError:
+            return
+        fn = data.get('function') if isinstance(data, dict) else None
+        code = getattr(inspect.unwrap(fn), '__code__', None) if fn else None
+        source = self.get_source_stamp(code.co_filename) if code else None
+        self.entries[filename] = {'stamp': stamp, 'is_async': is_async_fn(fn) if fn else None, 'source': source}
+        self.changed = True
+
+    def save(self):
+        if not self.cache or not self.changed:
+            return
+        for filename in [x for x in self.entries if not os.path.exists(x)]:
+            del self.entries[filename]
+        self.cache.set(collection_cache_key, self.entries)
+        self.changed = False
+
+
+def try_load_data_file(filename, is_async, only_changed, collection_cache=None):
+    try:
+        return load_data_file(filename, is_async, only_changed, collection_cache)
+    except Exception as e:
+        return e
+
+
+def try_load_parsed_data_file(filename, parsed, is_async, only_changed, collection_cache=None):
+    try:
+        data = deserialise_parsed(filename, parsed)
+        if collection_cache:
+            collection_cache.add(filename, data)
+        return load_test_cases(filename, data, is_async, only_changed)
+    except Exception as e:
+        return e
+
+
+def load_data_files(path_list, is_async, only_changed=False, collection_cache=None):
+    """
+    Loads the data files in the same order as `path_list`, on a pool of `collection_workers` threads or processes.
+    Exceptions are returned instead of raised.
+    """
+    if collection_workers <= 1 or len(path_list) <= 1:
+        return [try_load_data_file(path, is_async, only_changed, collection_cache) for path in path_list]
+    from concurrent import futures
+
+    if collection_executor == 'process':
+        # json parsing runs in the workers, the modules, classes and functions are looked up by name here
+        with futures.ProcessPoolExecutor(collection_workers) as executor:
+            parsed_list = list(executor.map(parse_data_file, path_list, chunksize=16))
+        return [
+            try_load_parsed_data_file(path, parsed, is_async, only_changed, collection_cache)
+            for path, parsed in zip(path_list, parsed_list)
+        ]
+    with futures.ThreadPoolExecutor(collection_workers) as executor:
+        count = len(path_list)
+        return list(
+            executor.map(
+                try_load_data_file, path_list, [is_async] * count, [only_changed] * count, [collection_cache] * count
+            )
+        )
+
+
+def add_pytest_options(parser):
+    parser.addoption(
+        '--pytest-cleanup-changed-only',
+        action='store_true',
+        help='only run pytest_cleanup test cases whose function, or a module it depends on, changed since recording',
+    )
+
+
+def parametrize_stg_tests(metafunc: 'Metafunc'):
     if metafunc.definition.name == 'test_pytest_cleanup_async_test_cases':
         _parametrize_stg_tests(metafunc, is_async=True)
     if metafunc.definition.name == 'test_pytest_cleanup_sync_test_cases':
         _parametrize_stg_tests(metafunc, is_async=False)
 
 
-def _parametrize_stg_tests(metafunc: Metafunc, is_async):
+def _parametrize_stg_tests(metafunc: 'Metafunc', is_async):
     sep = os.sep
-    path_list = list(sorted(glob(f'{test_data_directory}{sep}*{sep}**{sep}*.json', recursive=True)))
+    path_list = get_data_file_paths()
     all_test_data = []
     all_ids = []
-    for data_file_path in path_list:
+    async_batch = None
+    if batch_async_cases or batch_data_files:
+        if is_async:
+            # async cases are batched into the sync test instead
+            path_list = []
+        else:
+            is_async = None
+            async_batch = None if batch_data_files else AsyncBatch()
+    only_changed = changed_only or metafunc.config.getoption('pytest_cleanup_changed_only', default=False)
+    collection_cache = CollectionCache.from_config(metafunc.config)
+    path_list = collection_cache.filter(path_list, is_async)
+    loaded = load_data_files(path_list, is_async, only_changed, collection_cache)
+    collection_cache.save()
+    for data_file_path, tuple_result in zip(path_list, loaded):
         split = data_file_path.split(sep)
         function_name = split[-2]
-        try:
-            tuple_result = load_data_file(data_file_path, is_async)
-            if tuple_result:
-                module, clazz, test_cases = tuple_result
-            else:
-                continue
-        except Exception as e:
+        if isinstance(tuple_result, Exception):
             logger.error(f'Could not load data file {data_file_path}')
-            logger.error(e)
-            raise e
+            logger.error(tuple_result)
+            raise tuple_result
+        if not tuple_result:
+            continue
+        module, clazz, test_cases = tuple_result
         module_name = get_name(module)
         class_name = get_name(clazz)
         class_or_module_name = module_name if module_name != class_name else f'{module_name}.{class_name}'
         ids = [f'{class_or_module_name}-{function_name}'] * len(test_cases)
+        if batch_data_files:
+            data_file_name = os.path.splitext(split[-1])[0]
+            test_cases = [(DataFileBatch(data_file_path, test_cases), (), {}, None, None)]
+            ids = [f'{class_or_module_name}-{function_name}-{data_file_name}']
+        if async_batch and test_cases and is_async_fn(inspect.unwrap(test_cases[0][0])):
+            test_cases = [
+                (async_batch.add(fn, args, kwargs), (), {}, expected, None)
+                for fn, args, kwargs, expected, duration in test_cases
+            ]
         all_test_data.extend(test_cases)
         all_ids.extend(ids)
-    metafunc.parametrize(['fn', 'args', 'kwargs', 'expected'], all_test_data, ids=all_ids)
+    argnames = ['fn', 'args', 'kwargs', 'expected', 'duration']
+    if 'duration' not in metafunc.fixturenames:
+        # test file generated before call durations were recorded
+        argnames = argnames[:-1]
+        all_test_data = [x[:-1] for x in all_test_data]
+    metafunc.parametrize(argnames, all_test_data, ids=all_ids)
@@ -0,0 +1,130 @@
+"""Large buffers saved as raw binary side files next to data files, and memory-mapped back when loading them."""
+import os
+
+sidecar_threshold = int(os.environ.get('PYTESTCLEANUP_SIDECAR_THRESHOLD_KB', '64')) * 1024
+
+
+def is_numpy_array(value):
+    # numpy is optional, there's no need to import it to tell if a value is an array
+    value_type = type(value)
+    return value_type.__name__ == 'ndarray' and value_type.__module__ == 'numpy'
+
+
+class SidecarBuffer:
+    """
+    Stands in for a large bytes, bytearray, array.array, memoryview or numpy array in data files.
+    Its raw contents are kept in a side file named after their digest, which is memory-mapped when loading it:
+    memoryviews and numpy arrays are loaded without copying, the other types are copied once.
+    """
+
+    def __init__(self, kind, digest, metadata=None, contents=None):
+        self.kind = kind
+        self.digest = digest
+        self.metadata = metadata or {}
+        self.contents = contents
+
+    def __getstate__(self):
+        return {'kind': self.kind, 'digest': self.digest, 'metadata': self.metadata}
+
+    def __setstate__(self, state):
+        self.__init__(state['kind'], state['digest'], state['metadata'])
+
+    def __eq__(self, other):
+        return isinstance(other, SidecarBuffer) and (self.kind, self.digest, self.metadata) == (
+            other.kind,
+            other.digest,
+            other.metadata,
+        )
+
+    def __repr__(self):
+        return f'SidecarBuffer({self.kind}, {self.digest})'
+
+    @classmethod
+    def from_value(cls, value):
+        """Returns None if `value` isn't a buffer bigger than the threshold"""
+        import array
+
+        if not sidecar_threshold:
+            return None
+        if isinstance(value, (bytes, bytearray)):
+            kind, metadata, size = type(value).__name__, {}, len(value)
+        elif isinstance(value, array.array):
+            kind, metadata, size = 'array', {'typecode': value.typecode}, len(value) * value.itemsize
+        elif isinstance(value, memoryview):
+            kind, metadata, size = 'memoryview', {'format': value.format, 'shape': list(value.shape)}, value.nbytes
+        elif is_numpy_array(value) and not value.dtype.hasobject:
+            kind, metadata, size = 'numpy', {'dtype': value.dtype.str, 'shape': list(value.shape)}, value.nbytes
+        else:
+            return None
+        if size <= sidecar_threshold:
+            return None
+        import hashlib
+
+        # in C order, whatever the layout of the value
+        contents = value.tobytes() if kind in ('array', 'memoryview', 'numpy') else bytes(value)
+        return cls(kind, hashlib.sha256(contents).hexdigest(), metadata, contents)
+
+    def get_filename(self, directory):
+        return os.path.join(directory, f'{self.digest}.bin')
+
+    def save(self, directory):
+        filename = self.get_filename(directory)
+        if self.contents is None or os.path.exists(filename):
+            return
+        with open(filename, 'wb') as f:
+            f.write(self.contents)
+
+    def load(self, directory):
+        import mmap
+
+        with open(self.get_filename(directory), 'rb') as f:
+            # copy-on-write, so that functions may still modify their arguments
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        if self.kind == 'bytes':
+            return mapped[:]
+        if self.kind == 'bytearray':
+            return bytearray(mapped)
+        if self.kind == 'array':
+            import array
+
+            result = array.array(self.metadata['typecode'])
+            result.frombytes(mapped)
+            return result
+        if self.kind == 'memoryview':
+            view = memoryview(mapped)
+            if self.metadata['format'] == 'B' and len(self.metadata['shape']) == 1:
+                return view
+            return view.cast(self.metadata['format'], self.metadata['shape'])
+        if self.kind == 'numpy':
+            import numpy
+
+            return numpy.frombuffer(mapped, dtype=self.metadata['dtype']).reshape(self.metadata['shape'])
+        raise ValueError(f'Unknown kind of sidecar buffer: {self.kind}')
+
+
+def externalise_buffers(param):
+    """Replaces large buffers in args, kwargs or a return value by their SidecarBuffer"""
+    if isinstance(param, tuple):
+        return tuple(externalise_buffers(x) for x in param)
+    if isinstance(param, dict):
+        return {k: externalise_buffers(v) for k, v in param.items()}
+    return SidecarBuffer.from_value(param) or param
+
+
+def load_buffers(param, directory):
+    """Inverse of externalise_buffers, side files are looked up in `directory`"""
+    if isinstance(param, tuple):
+        return tuple(load_buffers(x, directory) for x in param)
+    if isinstance(param, dict):
+        return {k: load_buffers(v, directory) for k, v in param.items()}
+    if isinstance(param, SidecarBuffer):
+        return param.load(directory)
+    return param
+
+
+def get_sidecar_buffers(param):
+    if isinstance(param, tuple):
+        return [x for item in param for x in get_sidecar_buffers(item)]
+    if isinstance(param, dict):
+        return [x for item in param.values() for x in get_sidecar_buffers(item)]
+    return [param] if isinstance(param, SidecarBuffer) else []
@@ -0,0 +1,151 @@
+"""Line coverage collection, used to tell apart test cases that exercise different code paths."""
+import sys
+import threading
+
+from loguru import logger
+
+_local = threading.local()
+_lock = threading.Lock()
+_monitoring_users = 0
+_monitoring_tool_id = None
+# the tool id is taken by another tool, e.g coverage.py, no need to try again
+_monitoring_unavailable = False
+# files that collectors want the lines of, None if one of them wants all files
+_wanted_filenames = set()
+# whether sys.monitoring was told to stop sending the line events of some code
+_disabled_events = False
+
+
+def get_active_collectors():
+    if not hasattr(_local, 'collectors'):
+        _local.collectors = []
+    return _local.collectors
+
+
+def has_monitoring():
+    return hasattr(sys, 'monitoring')
+
+
+def is_wanted(filename):
+    return _wanted_filenames is None or filename in _wanted_filenames
+
+
+def add_wanted_filenames(filenames):
+    global _wanted_filenames
+    with _lock:
+        if _wanted_filenames is None or (filenames is not None and filenames <= _wanted_filenames):
+            return
+        _wanted_filenames = None if filenames is None else _wanted_filenames | set(filenames)
+        if _disabled_events and has_monitoring():
+            # code disabled earlier may be wanted now
+            sys.monitoring.restart_events()
+
+
+def _record_line(filename, line_number):
+    for collector in get_active_collectors():
+        collector.add(filename, line_number)
+
+
+def _on_line_event(code, line_number):
+    global _disabled_events
+    if not is_wanted(code.co_filename):
+        # no more events for this line, so that code outside the measured files runs at full speed
+        _disabled_events = True
+        return sys.monitoring.DISABLE
+    _record_line(code.co_filename, line_number)
+
+
+def _trace_lines(frame, event, arg):
+    if event == 'line':
+        _record_line(frame.f_code.co_filename, frame.f_lineno)
+    return _trace_lines
+
+
+def _trace_calls(frame, event, arg):
+    if event != 'call' or not is_wanted(frame.f_code.co_filename):
+        return None
+    return _trace_lines
+
+
+def _start_monitoring():
+    global _monitoring_users, _monitoring_tool_id, _monitoring_unavailable
+    with _lock:
+        if _monitoring_unavailable:
+            return False
+        if _monitoring_tool_id is None:
+            monitoring = sys.monitoring
+            try:
+                monitoring.use_tool_id(monitoring.COVERAGE_ID, 'pytest_cleanup')
+            except ValueError:
+                # e.g coverage.py is already using it
+                logger.warning('sys.monitoring coverage tool is in use, cannot collect coverage of test cases')
+                _monitoring_unavailable = True
+                return False
+            _monitoring_tool_id = monitoring.COVERAGE_ID
+            monitoring.register_callback(_monitoring_tool_id, monitoring.events.LINE, _on_line_event)
+            monitoring.set_events(_monitoring_tool_id, monitoring.events.LINE)
+        _monitoring_users += 1
+        return True
+
+
+def _stop_monitoring():
+    global _monitoring_users, _monitoring_tool_id
+    with _lock:
+        _monitoring_users -= 1
+        if _monitoring_users or _monitoring_tool_id is None:
+            return
+        monitoring = sys.monitoring
+        monitoring.set_events(_monitoring_tool_id, monitoring.events.NO_EVENTS)
+        monitoring.register_callback(_monitoring_tool_id, monitoring.events.LINE, None)
+        monitoring.free_tool_id(_monitoring_tool_id)
+        _monitoring_tool_id = None
+
+
+def _start_tracing():
+    if has_monitoring():
+        return _start_monitoring()
+    if sys.gettrace() is not None:
+        # don't get in the way of debuggers and coverage tools
+        return False
+    sys.settrace(_trace_calls)
+    return True
+
+
+def _stop_tracing():
+    if has_monitoring():
+        _stop_monitoring()
+    else:
+        sys.settrace(None)
+
+
+class LineCoverage:
+    """
+    Context manager collecting the (filename, line number) pairs executed in the current thread while it is active.
+    Uses sys.monitoring where available, sys.settrace otherwise.
+    `lines` is None if coverage could not be collected.
+    """
+
+    def __init__(self, filenames=None):
+        self.filenames = filenames
+        self.lines = None
+
+    def add(self, filename, line_number):
+        if self.filenames is None or filename in self.filenames:
+            self.lines.add((filename, line_number))
+
+    def __enter__(self):
+        add_wanted_filenames(self.filenames)
+        collectors = get_active_collectors()
+        if not collectors and not _start_tracing():
+            return self
+        self.lines = set()
+        collectors.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        collectors = get_active_collectors()
+        if self not in collectors:
+            return
+        collectors.remove(self)
+        if not collectors:
+            _stop_tracing()
@@ -0,0 +1,31 @@
+"""checks that importing the recorder stays cheap, run with `python -m tests.import_time`"""
+import os
+import subprocess
+import sys
+
+budget_seconds = float(os.environ.get('IMPORT_TIME_BUDGET_SECONDS', '0.5'))
+# only needed when saving or loading test data, or when running under pytest
+deferred_modules = ['dill', 'jsonpickle', '_pytest', 'pytest', 'pytest_cleanup.runtime']
+
+measure_import = f"""
+import sys
+import time
+
+start = time.perf_counter()
+from pytest_cleanup import Recorder
+print(time.perf_counter() - start)
+print(','.join(name for name in {deferred_modules!r} if name in sys.modules))
+"""
+
+
+def main():
+    output = subprocess.check_output([sys.executable, '-c', measure_import], stderr=subprocess.DEVNULL)
+    elapsed, loaded = output.decode().splitlines()[-2:]
+    elapsed = float(elapsed)
+    print(f'Importing the recorder took {elapsed:.3f}s')
+    assert not loaded, f'Importing the recorder should not import {loaded}'
+    assert elapsed < budget_seconds, f'Importing the recorder took {elapsed:.3f}s, budget is {budget_seconds}s'
+
+
+if __name__ == '__main__':
+    main()